@@ -20,7 +20,10 @@
 
 
 import logging
-import yaml
+import multiprocessing as mp
+
+from rnaiutilities.globals import TSV, DATA_FORMATS
+from rnaiutilities.utility.files import read_yaml
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -33,20 +36,60 @@ class Config:
     __PLATE_FOLDER__ = "plate_folder"
     __OUTPUT_PATH__ = "output_path"
     __MULTI_PROCESSING__ = "multiprocessing"
+    __OUTPUT_FORMAT__ = "output_format"
+    __RAGGED_FEATURES__ = "ragged_features"
+    __FEATURE_DTYPE__ = "feature_dtype"
+    __FILE_THREADS__ = "file_threads"
+    __WORKERS__ = "workers"
+    __TASKS_PER_CHILD__ = "tasks_per_child"
     __CONFIG__ = [
         __PLATE_FOLDER__, __PLATE_ID_FILE__, __LAYOUT_FILE__,
         __MULTI_PROCESSING__, __OUTPUT_PATH__, __PLATE_REGEX__
     ]
+    # optional entries of the config and the values used if they are missing
+    __OPTIONAL_CONFIG__ = {
+        __OUTPUT_FORMAT__: TSV,
+        __RAGGED_FEATURES__: True,
+        __FEATURE_DTYPE__: "float64",
+        __FILE_THREADS__: 1,
+        __WORKERS__: None,
+        __TASKS_PER_CHILD__: None
+    }
+    __FEATURE_DTYPES__ = ["float64", "float32"]
 
     def __init__(self, credentials):
-        with open(credentials, 'r') as f:
-            doc = yaml.load(f)
-            for credential in Config.__CONFIG__:
-                if credential not in doc:
-                    logger.error(
-                      "Could not find credential: " + str(credential))
-                    exit(-1)
-                setattr(self, "_" + credential, doc[credential])
+        doc = read_yaml(credentials)
+        for credential in Config.__CONFIG__:
+            if credential not in doc:
+                logger.error(
+                  "Could not find credential: " + str(credential))
+                exit(-1)
+            setattr(self, "_" + credential, doc[credential])
+        for credential, default in Config.__OPTIONAL_CONFIG__.items():
+            setattr(self, "_" + credential, doc.get(credential, default))
+        if self.output_format not in DATA_FORMATS:
+            logger.error(
+              "Output format needs to be one of: " + "/".join(DATA_FORMATS))
+            exit(-1)
+        if self.feature_dtype not in Config.__FEATURE_DTYPES__:
+            logger.error(
+              "Feature dtype needs to be one of: " +
+              "/".join(Config.__FEATURE_DTYPES__))
+            exit(-1)
+        if not Config._is_positive_int(self.file_threads):
+            logger.error("File threads need to be a positive integer")
+            exit(-1)
+        for credential in [Config.__WORKERS__, Config.__TASKS_PER_CHILD__]:
+            value = getattr(self, "_" + credential)
+            if value is not None and not Config._is_positive_int(value):
+                logger.error(
+                  "{} needs to be a positive integer".format(credential))
+                exit(-1)
+
+    @staticmethod
+    def _is_positive_int(value):
+        return isinstance(value, int) and not isinstance(value, bool) \
+            and value > 0
 
     @property
     def plate_id_file(self):
@@ -71,3 +114,31 @@ class Config:
     @property
     def plate_regex(self):
         return getattr(self, "_" + Config.__PLATE_REGEX__)
+
+    @property
+    def output_format(self):
+        return str(getattr(self, "_" + Config.__OUTPUT_FORMAT__)).lower()
+
+    @property
+    def ragged_features(self):
+        return bool(getattr(self, "_" + Config.__RAGGED_FEATURES__))
+
+    @property
+    def feature_dtype(self):
+        return str(getattr(self, "_" + Config.__FEATURE_DTYPE__)).lower()
+
+    @property
+    def file_threads(self):
+        return getattr(self, "_" + Config.__FILE_THREADS__)
+
+    @property
+    def workers(self):
+        # all but one core if the number of processes is not set
+        n_workers = getattr(self, "_" + Config.__WORKERS__)
+        if n_workers is None:
+            n_workers = max(1, mp.cpu_count() - 1)
+        return n_workers
+
+    @property
+    def tasks_per_child(self):
+        return getattr(self, "_" + Config.__TASKS_PER_CHILD__)
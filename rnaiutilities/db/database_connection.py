@@ -43,12 +43,11 @@ class DatabaseConnection(metaclass=abc.ABCMeta):
     def execute(self, statement):
         pass
 
-    @abc.abstractmethod
-    def insert_many(self, many, tab):
-        pass
+    def commit(self):
+        self._connection.commit()
 
     @abc.abstractmethod
-    def insert_elements(self, file, meta, f):
+    def insert_rows(self, tab, columns, rows, f):
         pass
 
     @abc.abstractmethod
@@ -24,6 +24,8 @@ import logging
 from rnaiutilities.globals import FEATURECLASS, WELL
 from rnaiutilities.globals import GENE, SIRNA, LIBRARY, DESIGN
 from rnaiutilities.globals import REPLICATE, PLATE, STUDY, PATHOGEN
+from rnaiutilities.globals import FEATURESET, FILE_FEATURESET, METAFILE, \
+    QUERY_FILES
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -206,41 +208,87 @@ class DatabaseQueryBuilder:
         return s
 
     @staticmethod
-    def create_into_meta_statement(
-      file, study, bacteria, library, design, replicate, plate, featureclass):
-        s = "INSERT INTO meta " \
-            "({}, {}, {}, {}, {}, {}, {}, {}) " \
-                .format(STUDY, PATHOGEN, LIBRARY, DESIGN,
-                        REPLICATE, PLATE, FEATURECLASS, "filename") + \
-            "VALUES ('{}', '{}', '{}', '{}', '{}', '{}', '{}', '{}');" \
-                .format(study, bacteria, library, design, replicate, plate,
-                        featureclass, file)
+    def meta_columns():
+        return DatabaseQueryBuilder._descr_ + ["filename"]
 
+    @staticmethod
+    def insert_rows_statement(tab, columns, values):
+        s = "INSERT INTO {} ({}) VALUES {}" \
+            .format(tab, ", ".join(columns), values)
+        return s
+
+    @staticmethod
+    def create_featureset_table():
+        s = "CREATE TABLE IF NOT EXISTS {} ".format(FEATURESET) + \
+            "(" + \
+            "{} varchar(40) NOT NULL, ".format(FEATURESET) + \
+            "feature varchar(1000) NOT NULL, " + \
+            "PRIMARY KEY({}, feature)".format(FEATURESET) + \
+            ");"
+        logger.info(s)
         return s
 
     @staticmethod
-    def insert_into_statement(k, v, file):
-        s = "INSERT INTO {} ({}, filename) VALUES('{}', '{}')" \
-            .format(k, k, v, file)
+    def create_file_featureset_table():
+        s = "CREATE TABLE IF NOT EXISTS {} ".format(FILE_FEATURESET) + \
+            "(" + \
+            "filename varchar(1000) NOT NULL, " + \
+            "{} varchar(40) NOT NULL, ".format(FEATURESET) + \
+            "PRIMARY KEY(filename)" + \
+            ");"
+        logger.info(s)
         return s
 
     @staticmethod
-    def create_file_feature_table(tab):
-        s = "CREATE TABLE IF NOT EXISTS {}".format(tab) + \
-            " (feature varchar(1000) NOT NULL, " + \
-            "PRIMARY KEY(feature));"
+    def create_metafile_table():
+        s = "CREATE TABLE IF NOT EXISTS {} ".format(METAFILE) + \
+            "(" + \
+            "filename varchar(1000) NOT NULL, " + \
+            "size bigint NOT NULL, " + \
+            "mtime double precision NOT NULL, " + \
+            "PRIMARY KEY(filename)" + \
+            ");"
         logger.info(s)
         return s
 
+    @staticmethod
+    def delete_query_files_statement(tab):
+        s = "DELETE FROM {} WHERE filename IN ".format(tab) + \
+            "(SELECT filename FROM {});".format(QUERY_FILES)
+        return s
+
+    @staticmethod
+    def create_query_files_table():
+        s = "CREATE TEMPORARY TABLE IF NOT EXISTS {} ".format(QUERY_FILES) + \
+            "(" + \
+            "filename varchar(1000) NOT NULL, " + \
+            "PRIMARY KEY(filename)" + \
+            ");"
+        return s
+
+    @staticmethod
+    def clear_table_statement(tab):
+        return "DELETE FROM {};".format(tab)
+
+    @staticmethod
+    def file_features_query():
+        s = "SELECT q.filename, f.feature FROM {} q ".format(QUERY_FILES) + \
+            "JOIN {} ff ON (q.filename = ff.filename) ".format(
+              FILE_FEATURESET) + \
+            "JOIN {} f ON (ff.{} = f.{});".format(
+              FEATURESET, FEATURESET, FEATURESET)
+        return s
+
     @staticmethod
     def create_meta_index():
-        s = "CREATE INDEX meta_index ON meta ({});" \
+        s = "CREATE INDEX IF NOT EXISTS meta_index ON meta ({});" \
             .format(", ".join(DatabaseQueryBuilder._descr_))
         logger.info(s)
         return s
 
     @staticmethod
     def create_table_index(t):
-        s = "CREATE INDEX {}_index ON {} ({});".format(t, t, t)
+        s = "CREATE INDEX IF NOT EXISTS {}_index ON {} ({});" \
+            .format(t, t, t)
         logger.info(s)
         return s
@@ -23,19 +23,25 @@ Module related to all data base managment function, i.e., writing/selecting or
  opening DB connections.
 """
 
+import functools
 import logging
 import os
 import re
 import sys
+import time
 from itertools import chain
 
 from rnaiutilities.db.db_query_builder import DatabaseQueryBuilder
 from rnaiutilities.db.postgres_connection import PostgresConnection
 from rnaiutilities.db.sqlite_connection import SQLiteConnection
-from rnaiutilities.db.utility import feature_table_name
+from rnaiutilities.db.utility import feature_table_name, featureset_hash
 from rnaiutilities.globals import GENE, SIRNA, WELL, ELEMENTS, FEATURES
+from rnaiutilities.globals import META, FEATURESET, FILE_FEATURESET, \
+    METAFILE, QUERY_FILES
 from rnaiutilities.table_file_set import TableFileSet
-from rnaiutilities.utility.files import filter_files, read_yaml
+from rnaiutilities.utility.array import unique
+from rnaiutilities.utility.files import filter_files, read_meta
+from rnaiutilities.utility.pool import bounded_imap
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -47,6 +53,8 @@ class DBMS:
     """
 
     _SQLITE_ = "sqlite"
+    # number of meta files that are inserted in a single transaction
+    _BATCH_SIZE_ = 100
     _FILE_FEATURES_REGEX_ = re.compile(
       "(\w+)-(\w+)-(\w+)-(\w+)-(\w+)-(\d+)-(.*)_(\w+)")
 
@@ -98,6 +106,7 @@ class DBMS:
 
     def _compose_tableset(self, results, **kwargs):
         plate_file_map = self._plate_file_map(results)
+        feature_map = self._feature_map(results)
         # setup table file list
         fls = [
             TableFileSet(
@@ -108,8 +117,7 @@ class DBMS:
               # the different feature group files like cell/nuclei/perinuclei
               x,
               # chain lists of features to one list total
-              list(chain.from_iterable(
-                [self._feature_query(e[-1]) for e in x])),
+              list(chain.from_iterable([feature_map[e[-1]] for e in x])),
               # filtering information
               **kwargs)
             for k, x in plate_file_map.items()
@@ -135,6 +143,33 @@ class DBMS:
 
         return result_set_map
 
+    def _feature_map(self, results):
+        # get the feature lists of all files with a single join of the files
+        # with their feature sets
+        files = unique([e[-1] for e in results])
+        feature_map = {f: [] for f in files}
+        if self.__connection.exists(FILE_FEATURESET):
+            d = DatabaseQueryBuilder()
+            self._fill_query_files(files)
+            for f, feature in self.__connection.query(d.file_features_query()):
+                feature_map[f].append(feature)
+        # files inserted by older versions are stored in one table per file
+        for f in files:
+            if not feature_map[f] and \
+                    self.__connection.exists(feature_table_name(f)):
+                feature_map[f] = self._feature_query(f)
+        return feature_map
+
+    def _fill_query_files(self, files):
+        # the files are bound as parameters into a temporary table that
+        # statements join with instead of listing them in the statement
+        d = DatabaseQueryBuilder()
+        self.__connection.execute(d.create_query_files_table())
+        self.__connection.execute(d.clear_table_statement(QUERY_FILES))
+        self.__connection.insert_rows(
+          QUERY_FILES, ["filename"], [(f,) for f in files],
+          d.insert_rows_statement)
+
     def _feature_query(self, filename):
         d = feature_table_name(filename)
         res = self.__connection.query("SELECT distinct * FROM {}".format(d))
@@ -151,22 +186,25 @@ class DBMS:
     def query(self, **kwargs):
         return self._query(file_name=None, **kwargs)
 
-    def insert(self, path):
+    def insert(self, path, workers=1):
         """
         Insert meta information from parsed imaging data into a database.
         Creates a couple of different databases for all created meta files
         containing information about plates, filenames, siRNAs, genes, etc.
 
         :param path: the path where the parsed files are placed
+        :param workers: number of processes that read the meta files. Rows are
+         still written by a single connection.
+        :type workers: int
         :return: str
         """
 
-        self._insert(path)
+        self._insert(path, workers)
 
-    def _insert(self, path):
+    def _insert(self, path, workers):
         d = DatabaseQueryBuilder()
         self._create_tables(d)
-        self._insert_files(path, d)
+        self._insert_files(path, d, workers)
         self._create_indexes(d)
 
     def _create_tables(self, d):
@@ -176,15 +214,137 @@ class DBMS:
         for col in [GENE, SIRNA, WELL]:
             tb = d.create_table_name(col)
             self.__connection.execute(tb)
+        # feature sets are stored once and mapped to files
+        self.__connection.execute(d.create_featureset_table())
+        self.__connection.execute(d.create_file_featureset_table())
+        # keeps track of inserted meta files, so that we only insert new ones
+        upgrade = not self.__connection.exists(METAFILE)
+        self.__connection.execute(d.create_metafile_table())
+        if upgrade:
+            self._register_inserted_files(d)
+
+    def _register_inserted_files(self, d):
+        # databases from older versions have no metafile table, so the files
+        # in the meta table are registered with their current size/mtime.
+        # files that cannot be found count as changed, so that their rows
+        # are replaced instead of duplicated when they are inserted again
+        files = unique([x[0] for x in self.__connection.query(
+          "SELECT distinct filename FROM {}".format(META))])
+        if not files:
+            return
+        logger.info("Registering {} inserted meta files.".format(len(files)))
+        rows = []
+        for filename in files:
+            try:
+                rows.append((filename,) + self._file_stat(filename))
+            except OSError:
+                rows.append((filename, -1, -1.0))
+        self.__connection.insert_rows(
+          METAFILE, ["filename", "size", "mtime"], rows,
+          d.insert_rows_statement)
+        self.__connection.commit()
+
+    def _insert_files(self, path, d, workers):
+        fls = self._files_to_insert(path, d)
+        known = set(map(lambda x: x[0], self.__connection.query(
+          "SELECT distinct {} FROM {}".format(FEATURESET, FEATURESET))))
+        batches = [fls[i:i + DBMS._BATCH_SIZE_]
+                   for i in range(0, len(fls), DBMS._BATCH_SIZE_)]
+        start, n_rows = time.time(), 0
+        for i, (rows, featuresets) in enumerate(
+          self._read_batches(path, batches, workers)):
+            logger.info("Doing file {} of {}".format(
+              i * DBMS._BATCH_SIZE_ + 1, len(fls)))
+            n_rows += self._insert_batch(d, rows, featuresets, known)
+        elapsed = time.time() - start
+        logger.info("Inserted {} rows in {:.2f}s ({:.0f} rows/s)".format(
+          n_rows, elapsed, n_rows / max(elapsed, 1e-9)))
+
+    def _files_to_insert(self, path, d):
+        # only insert meta files that are new or whose size/mtime changed.
+        # rows of changed files are removed first
+        inserted = {f: (size, mtime) for f, size, mtime in
+                    self.__connection.query(
+                      "SELECT filename, size, mtime FROM {}".format(METAFILE))}
+        fls, changed, n_unchanged = [], [], 0
+        for file in filter_files(path, "_meta.tsv"):
+            filename = os.path.join(path, file)
+            if filename not in inserted:
+                fls.append(file)
+            elif inserted[filename] != self._file_stat(filename):
+                fls.append(file)
+                changed.append(filename)
+            else:
+                n_unchanged += 1
+        logger.info("Found {} new, {} changed and {} unchanged meta files."
+                    .format(len(fls) - len(changed), len(changed),
+                            n_unchanged))
+        if changed:
+            self._fill_query_files(changed)
+            for tab in [META, GENE, SIRNA, WELL, FILE_FEATURESET, METAFILE]:
+                self.__connection.execute(d.delete_query_files_statement(tab))
+        return fls
+
+    @staticmethod
+    def _file_stat(filename):
+        st = os.stat(filename)
+        return st.st_size, st.st_mtime
+
+    @staticmethod
+    def _read_batches(path, batches, workers):
+        if workers is None or workers <= 1:
+            for batch in batches:
+                yield DBMS._read_batch(path, batch)
+            return
+        # parse the meta files in a pool and keep at most two batches per
+        # process in flight, such that the writer is never far behind
+        logger.info("Reading meta files with {} processes.".format(workers))
+        yield from bounded_imap(
+          functools.partial(DBMS._read_batch, path), batches, workers)
+
+    @staticmethod
+    def _read_batch(path, files):
+        rows = {META: [], GENE: [], SIRNA: [], WELL: [], FILE_FEATURESET: [],
+                METAFILE: []}
+        featuresets = {}
+        for file in files:
+            DBMS._read_file(path, file, rows, featuresets)
+        return rows, featuresets
+
+    def _insert_batch(self, d, rows, featuresets, known):
+        # insert all rows of a batch of meta files in a single transaction
+        start = time.time()
+        # store feature sets only if no other file had the same features
+        rows[FEATURESET] = []
+        for key, features in featuresets.items():
+            if key not in known:
+                known.add(key)
+                rows[FEATURESET].extend((key, f) for f in unique(features))
+
+        n_rows = 0
+        for tab, tab_rows in rows.items():
+            if tab == META:
+                cols = d.meta_columns()
+            elif tab == FILE_FEATURESET:
+                cols = ["filename", FEATURESET]
+            elif tab == FEATURESET:
+                cols = [FEATURESET, "feature"]
+            elif tab == METAFILE:
+                cols = ["filename", "size", "mtime"]
+            else:
+                cols = [tab, "filename"]
+            self.__connection.insert_rows(
+              tab, cols, tab_rows, d.insert_rows_statement)
+            n_rows += len(tab_rows)
+        self.__connection.commit()
 
-    def _insert_files(self, path, d):
-        fls = filter_files(path, "_meta.tsv")
-        for i, file in enumerate(fls):
-            if i % 100 == 0:
-                logger.info("Doing file {} of {}".format(i + 1, len(fls)))
-            self._insert_file(d, path, file)
+        elapsed = time.time() - start
+        logger.info("\tinserted {} rows ({:.0f} rows/s)".format(
+          n_rows, n_rows / max(elapsed, 1e-9)))
+        return n_rows
 
-    def _insert_file(self, d, path, file):
+    @staticmethod
+    def _read_file(path, file, rows, featuresets):
         filename = os.path.join(path, file)
         try:
             ma = DBMS._FILE_FEATURES_REGEX_.match(file.replace("_meta.tsv", ""))
@@ -192,25 +352,27 @@ class DBMS:
             # put the file classifier suffixes into the meta database
             # this really only regards the NAME of the file, the FEATURE it
             # is containing and the meta that describes the plate
-            ins = d.create_into_meta_statement(
-              filename, stu, pat, lib, des, rep, pl, feature)
-            self.__connection.execute(ins)
-            # read the meta file and put the meta plate information
-            # (genes, sirnas) into the database for the plate
-            meta = read_yaml(filename)
-            self._insert_meta(filename, meta, d)
-        except ValueError:
+            rows[META].append(
+              (stu, pat, lib, des, rep, pl, feature, filename))
+        except (ValueError, AttributeError):
             logger.error("Could not match meta file {}".format(file))
-
-    def _insert_meta(self, file, meta, d):
-        self.__connection.insert_elements(
-          file, meta[ELEMENTS], d.insert_into_statement)
-
-        tab = feature_table_name(file)
-        if not self.__connection.exists(tab):
-            s = d.create_file_feature_table(tab)
-            self.__connection.execute(s)
-            self.__connection.insert_many(meta[FEATURES], tab)
+            return
+        # read the meta file and put the meta plate information
+        # (genes, sirnas) into the database for the plate
+        rows[METAFILE].append((filename,) + DBMS._file_stat(filename))
+        meta = read_meta(filename)
+        for element in meta[ELEMENTS]:
+            try:
+                well, gene, sirna = element.split(";")[:3]
+                rows[WELL].append((well, filename))
+                rows[GENE].append((gene, filename))
+                rows[SIRNA].append((sirna, filename))
+            except ValueError as e:
+                logger.error(
+                  "Could not match element {} and error {}".format(element, e))
+        key = featureset_hash(meta[FEATURES])
+        rows[FILE_FEATURESET].append((filename, key))
+        featuresets[key] = meta[FEATURES]
 
     def _create_indexes(self, d):
         self.__connection.execute(d.create_meta_index())
@@ -22,9 +22,9 @@
 import logging
 
 import psycopg2
+import psycopg2.extras
 
 from rnaiutilities.db.database_connection import DatabaseConnection
-from rnaiutilities.globals import GENE, SIRNA, WELL
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -48,24 +48,11 @@ class PostgresConnection(DatabaseConnection):
             cursor.execute(statement)
         self._connection.commit()
 
-    def insert_many(self, many, tab):
-        with self._connection.cursor() as c:
-            for x in many:
-                c.execute("INSERT INTO {} VALUES ('{}')".format(tab, x))
-        self._connection.commit()
-
-    def insert_elements(self, file, meta, f):
+    def insert_rows(self, tab, columns, rows, f):
+        # rows are only committed by calling `commit`
+        ins = f(tab, columns, "%s")
         with self._connection.cursor() as cursor:
-            for element in meta:
-                try:
-                    well, gene, sirna = element.split(";")[:3]
-                    for k, v in {WELL: well, GENE: gene, SIRNA: sirna}.items():
-                        ins = f(k, v, file)
-                        cursor.execute(ins)
-                except ValueError as e:
-                    logger.error("Could not match element {} and error {}"
-                                 .format(element, e))
-        self._connection.commit()
+            psycopg2.extras.execute_values(cursor, ins, rows, page_size=1000)
 
     def exists(self, tab):
         s = "SELECT EXISTS(SELECT * FROM information_schema.tables" \
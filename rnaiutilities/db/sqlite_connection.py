@@ -23,7 +23,6 @@ import logging
 import sqlite3
 
 from rnaiutilities.db.database_connection import DatabaseConnection
-from rnaiutilities.globals import GENE, SIRNA, WELL
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -50,27 +49,12 @@ class SQLiteConnection(DatabaseConnection):
         cursor.close()
         self._connection.commit()
 
-    def insert_many(self, many, tab):
+    def insert_rows(self, tab, columns, rows, f):
+        # rows are only committed by calling `commit`
+        ins = f(tab, columns, "(" + ", ".join(["?"] * len(columns)) + ")")
         cursor = self._connection.cursor()
-        for x in many:
-            cursor.execute("INSERT INTO {} VALUES ('{}')".format(tab, x))
+        cursor.executemany(ins, rows)
         cursor.close()
-        self._connection.commit()
-
-    def insert_elements(self, file, meta, f):
-        cursor = self._connection.cursor()
-        for element in meta:
-            try:
-                well, gene, sirna = element.split(";")[:3]
-                for k, v in {WELL: well, GENE: gene,
-                             SIRNA: sirna}.items():
-                    ins = f(k, v, file)
-                    cursor.execute(ins)
-            except ValueError as e:
-                logger.error(
-                  "Could not match element {} and error {}".format(element, e))
-        cursor.close()
-        self._connection.commit()
 
     def exists(self, tab):
         s = "SELECT name FROM sqlite_master WHERE type='table' AND name='{}'" \
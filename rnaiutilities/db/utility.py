@@ -22,6 +22,8 @@
 Database utility functions
 """
 
+import hashlib
+
 
 def feature_table_name(file):
     """
@@ -32,3 +34,16 @@ def feature_table_name(file):
     """
 
     return file.replace("_meta.tsv", "").split("/")[-1].replace("-", "_")
+
+
+def featureset_hash(features):
+    """
+    Get the key of a feature set, i.e. a hash of its sorted, unique features.
+    Meta files that contain the same features have the same key.
+
+    :param features: the list of features of a meta file
+    :return: returns the key of the feature set
+    """
+
+    fs = "\n".join(sorted(set(features)))
+    return hashlib.sha1(fs.encode("utf-8")).hexdigest()
@@ -36,14 +36,36 @@ REPLICATE = "replicate"
 PLATE = "plate"
 FEATURECLASS = "featureclass"
 
+META = "meta"
 FEATURES = "features"
+FEATURESET = "featureset"
+FILE_FEATURESET = "file_featureset"
+METAFILE = "metafile"
+# temporary table of the files whose features are selected
+QUERY_FILES = "query_files"
 ELEMENTS = "elements"
+# row ranges of the wells in a parsed plate data file
+ROW_INDEX = "index"
+# per-feature moments of all cells of a parsed plate data file
+MOMENTS = "moments"
+# per-well moments and medians of all cells of a parsed plate data file
+WELL_STATISTICS = "wells"
 SAMPLE = "sample"
 
 BSCORE = "bscore"
 LOESS = "loess"
 ZSCORE = "zscore"
 
+# sets of plates over which feature statistics are pooled for normalization
+SCREEN = "screen"
+NORMALIZATION_LEVELS = [PLATE, REPLICATE, SCREEN]
+
+# formats in which parsed plate data files can be written
+TSV = "tsv"
+PARQUET = "parquet"
+FEATHER = "feather"
+DATA_FORMATS = [TSV, PARQUET, FEATHER]
+
 ADDED_COLUMNS_FOR_PRINTING = {
     'cells': [
         'parent_nuclei',
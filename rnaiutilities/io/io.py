@@ -19,11 +19,19 @@
 # @email = 'simon.dirmeier@bsse.ethz.ch'
 
 
+import io
 import logging
 import pathlib
 import sys
 
+import numpy
+import pandas
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+
 from rnaiutilities.data_set import DataSet
+from rnaiutilities.globals import PARQUET, FEATHER
 
 logger = logging.getLogger(__name__)
 
@@ -31,6 +39,14 @@ logger = logging.getLogger(__name__)
 class IO:
     _flat_ = "tsv"
     _h5_ = "h5"
+    # all plates are appended to one compressed table of an hdf5 file. strings
+    # of meta columns can be at most as long as the item size
+    _h5_key_ = "data"
+    _h5_complib_ = "blosc:zstd"
+    _h5_complevel_ = 5
+    _h5_itemsize_ = 100
+    # number of rows that are parsed at once when reading selected rows
+    _chunk_size_ = 2 ** 16
 
     def __init__(self, f):
         if f is None:
@@ -53,7 +69,189 @@ class IO:
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
+        self._close_h5()
+
+    @staticmethod
+    def read_table(filename, usecols=None, rows=None, runs=None):
+        """
+        Read a parsed plate data file into a data frame. The format of the file
+        is determined by its extension, i.e. 'tsv', 'parquet' or 'feather'.
+
+        If *rows* is given, the file is read in chunks and only the selected
+        rows of every chunk are kept, such that memory is bounded by the
+        selection and not by the size of the file. Row groups and record
+        batches of binary files without selected rows are skipped. For tsv
+        files, *runs* of rows with their byte offsets, as stored in the index
+        of the meta file, are used to seek to the selected rows directly.
+
+        :param filename: the name of the data file
+        :type filename: str
+        :param usecols: a callable that is evaluated on every column name and
+         decides if the column is read or None if all columns are read
+        :type usecols: callable
+        :param rows: sorted indexes of the rows to read or None if all rows
+         are read
+        :type rows: numpy.ndarray
+        :param runs: a list of first row, last row (exclusive), first byte and
+         last byte (exclusive) of runs of rows that contain all selected rows
+         or None
+        :type runs: list(list(int))
+        :return: returns the table as data frame
+        :rtype: pandas.DataFrame
+        """
+
+        if rows is not None:
+            return IO._take(IO._chunks(filename, usecols, rows, runs), rows)
+        if filename.endswith(PARQUET):
+            columns = IO._columns(
+              pyarrow.parquet.read_schema(filename).names, usecols)
+            return pandas.read_parquet(filename, columns=columns)
+        if filename.endswith(FEATHER):
+            columns = IO._columns(
+              pyarrow.ipc.open_file(filename).schema.names, usecols)
+            return pandas.read_feather(filename, columns=columns)
+        return pandas.read_csv(filename, sep="\t", header=0, usecols=usecols)
+
+    @staticmethod
+    def iter_table(filename, usecols=None, rows=None, runs=None,
+                   size=_chunk_size_):
+        """
+        Read a parsed plate data file in chunks of *size* rows, such that
+        only a chunk of the file is in memory at once. Reading the same rows
+        of files with the same number of rows gives aligned chunks.
+
+        :param filename: the name of the data file
+        :type filename: str
+        :param usecols: a callable that is evaluated on every column name and
+         decides if the column is read or None if all columns are read
+        :type usecols: callable
+        :param rows: sorted indexes of the rows to read or None if all rows
+         are read
+        :type rows: numpy.ndarray
+        :param runs: a list of first row, last row (exclusive), first byte and
+         last byte (exclusive) of runs of rows that contain all selected rows
+         or None
+        :type runs: list(list(int))
+        :param size: the number of rows of every chunk but the last
+        :type size: int
+        :return: returns a generator of data frames
+        :rtype: generator
+        """
+
+        chunks = IO._chunks(filename, usecols, rows, runs)
+        frames = (f for _, f in chunks) if rows is None \
+            else IO._taken(chunks, rows)
+        # the rows left over from the previous block are concatenated once
+        # with every block read, chunks are then sliced at a running offset
+        tail = None
+        for frame in frames:
+            block = frame if tail is None \
+                else pandas.concat([tail, frame], ignore_index=True)
+            offset = 0
+            while len(block) - offset >= size:
+                yield block.iloc[offset:offset + size].reset_index(drop=True)
+                offset += size
+            tail = block.iloc[offset:] if offset < len(block) else None
+        if tail is not None:
+            yield tail.reset_index(drop=True)
+
+    @staticmethod
+    def _chunks(filename, usecols, rows, runs):
+        # yields the first row of every chunk and the chunk, all chunks if
+        # rows is None
+        if filename.endswith(PARQUET):
+            fh = pyarrow.parquet.ParquetFile(filename)
+            columns = IO._columns(
+              pyarrow.parquet.read_schema(filename).names, usecols)
+            start = 0
+            for i in range(fh.num_row_groups):
+                end = start + fh.metadata.row_group(i).num_rows
+                if IO._overlaps(rows, start, end):
+                    yield start, fh.read_row_group(
+                      i, columns=columns).to_pandas()
+                start = end
+        elif filename.endswith(FEATHER):
+            reader = pyarrow.ipc.open_file(pyarrow.memory_map(filename))
+            columns = IO._columns(reader.schema.names, usecols)
+            start = 0
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                end = start + batch.num_rows
+                if IO._overlaps(rows, start, end):
+                    table = pyarrow.Table.from_batches([batch])
+                    if columns is not None:
+                        table = table.select(columns)
+                    yield start, table.to_pandas()
+                start = end
+        elif runs is not None:
+            yield from IO._runs(filename, usecols, runs)
+        else:
+            start = 0
+            for chunk in pandas.read_csv(
+              filename, sep="\t", header=0, usecols=usecols,
+              chunksize=IO._chunk_size_):
+                yield start, chunk
+                start += len(chunk)
+
+    @staticmethod
+    def _runs(filename, usecols, runs):
+        with open(filename, "rb") as fh:
+            names = fh.readline().decode().rstrip("\n").split("\t")
+            for first, _, offset, end in IO._merge_runs(runs):
+                fh.seek(offset)
+                yield first, pandas.read_csv(
+                  io.BytesIO(fh.read(end - offset)), sep="\t", header=None,
+                  names=names, usecols=usecols)
+
+    @staticmethod
+    def _merge_runs(runs):
+        # read adjacent runs of the file at once, but not more rows than a
+        # chunk at once
+        merged = []
+        for run in sorted(runs):
+            if merged and merged[-1][1] == run[0] and \
+                    merged[-1][3] == run[2] and \
+                    run[1] - merged[-1][0] <= IO._chunk_size_:
+                merged[-1][1], merged[-1][3] = run[1], run[3]
+            else:
+                merged.append(list(run))
+        return merged
+
+    @staticmethod
+    def _overlaps(rows, start, end):
+        if rows is None:
+            return True
+        lo, hi = numpy.searchsorted(rows, [start, end])
+        return hi > lo
+
+    @staticmethod
+    def _take(chunks, rows):
+        taken = list(IO._taken(chunks, rows))
+        if not taken:
+            return pandas.DataFrame()
+        return pandas.concat(taken, ignore_index=True)
+
+    @staticmethod
+    def _taken(chunks, rows):
+        # yields the selected rows of every chunk
+        chunk, seen = None, False
+        for start, chunk in chunks:
+            end = start + len(chunk)
+            lo, hi = numpy.searchsorted(rows, [start, end])
+            if hi > lo:
+                seen = True
+                yield chunk.iloc[rows[lo:hi] - start]
+            # stop reading once the last selected row has been seen
+            if hi == len(rows):
+                break
+        if not seen and chunk is not None:
+            yield chunk.iloc[:0]
+
+    @staticmethod
+    def _columns(names, usecols):
+        if usecols is None:
+            return None
+        return [x for x in names if usecols(x)]
 
     def dump(self, df):
         if not isinstance(df, DataSet):
@@ -65,8 +263,41 @@ class IO:
         else:
             raise ValueError("What?")
 
-    def _to_h5(self, df):
-        df.to_hdf(self._filename, str(df))
+    def _to_h5(self, data):
+        """
+        Append a plate to the table of the hdf5 file. The meta columns, like
+        gene/well/etc., are stored as data columns, such that rows can be
+        queried on disk, e.g. using
+        `pandas.read_hdf(filename, "data", where="gene == 'star'")`.
+        """
+
+        if self._fh is None:
+            self._fh = pandas.HDFStore(
+              self._filename, mode="a", complevel=IO._h5_complevel_,
+              complib=IO._h5_complib_)
+        frame = data.data
+        features = set(data.feature_columns)
+        meta = [c for c in frame.columns if c not in features]
+        # categories can differ between plates, so store the values
+        frame = frame.astype(
+          {c: str for c in meta
+           if isinstance(frame[c].dtype, pandas.CategoricalDtype)})
+        self._fh.append(
+          IO._h5_key_, frame, format="table", data_columns=meta,
+          min_itemsize={c: IO._h5_itemsize_ for c in meta
+                        if frame[c].dtype == object},
+          index=False)
+        self._dataset = meta
+
+    def _close_h5(self):
+        if self._fh is None:
+            return
+        # index the data columns once all plates have been appended
+        if self._dataset:
+            self._fh.create_table_index(
+              IO._h5_key_, columns=self._dataset, optlevel=9, kind="full")
+        self._fh.close()
+        self._fh, self._dataset = None, None
 
     def _to_tsv(self, data):
         if self._format is None:
@@ -0,0 +1,260 @@
+# Copyright (C) 2016 Simon Dirmeier
+#
+# This file is part of rnaiutilities.
+#
+# rnaiutilities is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rnaiutilities is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rnaiutilities. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author = 'Simon Dirmeier'
+# @email = 'simon.dirmeier@bsse.ethz.ch'
+
+
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy
+import pandas
+
+from rnaiutilities.io.io import IO
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class PlateCache:
+    """
+    On-disk cache of decoded plate data files. For every data file the float
+    feature columns are stored as one memory-mapped numpy array and the
+    remaining meta columns as a feather file, such that repeated queries do
+    not parse the same text files again.
+
+    Entries are keyed by the path, modification time and size of the data
+    file. If the cache grows larger than its maximum size, the least recently
+    used entries are deleted. The sizes of the entries are read from disk
+    once and then kept up to date, such that reads do not scan the cache.
+    Processes that share a cache read entries under a shared file lock and
+    evict entries under an exclusive one, such that no process deletes an
+    entry that another one is loading.
+    """
+
+    _features_ = "features.npy"
+    _meta_ = "meta.feather"
+    _columns_ = "columns.json"
+    _lock_ = ".lock"
+
+    def __init__(self, folder, max_size=10 * 2 ** 30):
+        """
+        Constructor for PlateCache.
+
+        :param folder: the folder in which the cache is stored
+        :type folder: str
+        :param max_size: maximum size of the cache in bytes
+        :type max_size: int
+        """
+
+        self._folder = folder
+        self._max_size = max_size
+        # sizes of the entries in least recently used order and their total
+        self._entries = None
+        self._size = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def read_table(self, filename, usecols=None, rows=None):
+        """
+        Read a parsed plate data file from the cache. The file is decoded and
+        added to the cache first if it has not been cached yet.
+
+        :param filename: the name of the data file
+        :type filename: str
+        :param usecols: a callable that is evaluated on every column name and
+         decides if the column is read or None if all columns are read
+        :type usecols: callable
+        :param rows: sorted indexes of the rows to read or None if all rows
+         are read
+        :type rows: numpy.ndarray
+        :return: returns the table as data frame, whose feature columns are
+         read-only views of the memory-mapped array if all rows are read
+        :rtype: pandas.DataFrame
+        """
+
+        entry = os.path.join(self._folder, self._key(filename))
+        with self._lock(shared=True):
+            data = self._read_entry(filename, entry, usecols, rows)
+            self._touch(entry)
+        with self._lock(shared=False):
+            self._evict(entry)
+        return data
+
+    def _read_entry(self, filename, entry, usecols, rows):
+        # an entry that has been evicted by a process that does not lock the
+        # cache after it has been found is added and read once more
+        for retry in [False, True]:
+            if not os.path.isdir(entry):
+                logger.info("\tcaching {}.".format(filename))
+                self._add(filename, entry)
+            try:
+                # the modification time of an entry orders entries for
+                # eviction when the cache is opened again
+                os.utime(entry)
+                return self._load(entry, usecols, rows)
+            except FileNotFoundError:
+                if retry:
+                    raise
+                logger.info("\t{} has been evicted, caching it again."
+                            .format(filename))
+
+    @contextlib.contextmanager
+    def _lock(self, shared):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self._folder, PlateCache._lock_), "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _key(filename):
+        stat = os.stat(filename)
+        key = "{}:{}:{}".format(
+          os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def _add(self, filename, entry):
+        data = IO.read_table(filename)
+        # float features of any precision are stored as one float64 block,
+        # categorical meta columns have no numpy dtype
+        features = [c for c in data.columns
+                    if isinstance(data[c].dtype, numpy.dtype) and
+                    numpy.issubdtype(data[c].dtype, numpy.floating)]
+        meta = [c for c in data.columns if c not in set(features)]
+        # write to a temporary folder first, such that other processes never
+        # see incomplete entries
+        tmp = tempfile.mkdtemp(prefix=".", dir=self._folder)
+        try:
+            block = numpy.lib.format.open_memmap(
+              os.path.join(tmp, PlateCache._features_), mode="w+",
+              dtype="float64", shape=(len(data), len(features)),
+              fortran_order=True)
+            for i, c in enumerate(features):
+                block[:, i] = data[c].values
+            block.flush()
+            del block
+            data[meta].reset_index(drop=True).to_feather(
+              os.path.join(tmp, PlateCache._meta_))
+            with open(os.path.join(tmp, PlateCache._columns_), "w") as fh:
+                json.dump({"columns": list(data.columns),
+                           "features": features}, fh)
+            os.rename(tmp, entry)
+        except OSError:
+            # another process has added the entry in the meantime
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    @staticmethod
+    def _load(entry, usecols, rows):
+        with open(os.path.join(entry, PlateCache._columns_), "r") as fh:
+            columns = json.load(fh)
+        names = columns["columns"]
+        if usecols is not None:
+            names = [c for c in names if usecols(c)]
+        features = [c for c in columns["features"] if c in set(names)]
+        meta = [c for c in names if c not in set(features)]
+
+        frames = []
+        if meta:
+            table = pandas.read_feather(
+              os.path.join(entry, PlateCache._meta_), columns=meta)
+            if rows is not None:
+                table = table.iloc[rows].reset_index(drop=True)
+            frames.append(table)
+        if features:
+            frames.append(pandas.DataFrame(
+              PlateCache._feature_block(entry, columns["features"], features,
+                                        rows),
+              columns=features, copy=False))
+        if not frames:
+            return pandas.DataFrame(columns=names)
+        data = pandas.concat(frames, axis=1, copy=False)
+        if list(data.columns) != names:
+            data = data[names]
+        return data
+
+    @staticmethod
+    def _feature_block(entry, columns, features, rows):
+        # the memory-mapped block of the features, which is only copied if
+        # rows or non-consecutive columns are selected
+        block = numpy.load(
+          os.path.join(entry, PlateCache._features_), mmap_mode="r")
+        position = {c: i for i, c in enumerate(columns)}
+        idx = numpy.array([position[c] for c in features])
+        if rows is not None:
+            return block[numpy.ix_(rows, idx)]
+        if idx[-1] - idx[0] + 1 == len(idx):
+            return block[:, idx[0]:idx[-1] + 1]
+        return block[:, idx]
+
+    def _touch(self, entry):
+        if self._entries is None:
+            self._scan()
+        elif entry in self._entries:
+            self._entries.move_to_end(entry)
+        else:
+            self._entries[entry] = self._entry_size(entry)
+            self._size += self._entries[entry]
+
+    def _scan(self):
+        entries = []
+        for name in os.listdir(self._folder):
+            path = os.path.join(self._folder, name)
+            # skip entries that are being written
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            entries.append(
+              (os.path.getmtime(path), path, self._entry_size(path)))
+        self._entries = collections.OrderedDict(
+          (path, size) for _, path, size in sorted(entries))
+        self._size = sum(self._entries.values())
+
+    @staticmethod
+    def _entry_size(path):
+        try:
+            return sum(os.path.getsize(os.path.join(path, f))
+                       for f in os.listdir(path))
+        except OSError:
+            return 0
+
+    def _evict(self, keep):
+        for path in list(self._entries):
+            if self._size <= self._max_size:
+                break
+            if path == keep:
+                continue
+            logger.info("\tevicting {} from cache.".format(path))
+            shutil.rmtree(path, ignore_errors=True)
+            self._size -= self._entries.pop(path)
@@ -0,0 +1,140 @@
+# Copyright (C) 2016 Simon Dirmeier
+#
+# This file is part of rnaiutilities.
+#
+# rnaiutilities is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rnaiutilities is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rnaiutilities. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author = 'Simon Dirmeier'
+# @email = 'simon.dirmeier@bsse.ethz.ch'
+
+
+import numpy
+
+
+class FeatureMoments:
+    """
+    Running per-feature counts, means and sums of squared deviations that
+    can be updated with blocks of cells and merged with each other, such
+    that statistics over several plates never need more than one plate in
+    memory. NaNs and infinite values are ignored feature-wise.
+
+    Blocks are added in pieces of a fixed number of rows, such that the
+    moments of a plate are the same whether it is added at once or in
+    chunks of that size, e.g. when it is streamed from disk.
+    """
+
+    # number of rows that are added at once
+    _block_size_ = 2 ** 16
+
+    def __init__(self, n_features):
+        """
+        Constructor for FeatureMoments.
+
+        :param n_features: the number of feature columns
+        :type n_features: int
+        """
+
+        self._count = numpy.zeros(n_features)
+        self._mean = numpy.zeros(n_features)
+        self._m2 = numpy.zeros(n_features)
+
+    @staticmethod
+    def from_dict(moments):
+        """
+        Create moments from the counts, means and sums of squared deviations
+        that have been stored with `to_dict`.
+
+        :param moments: a dictionary of lists of counts, means and sums of
+         squared deviations, one entry for every feature
+        :type moments: dict
+        :return: returns the moments
+        :rtype: FeatureMoments
+        """
+
+        res = FeatureMoments(len(moments["count"]))
+        res._count = numpy.asarray(moments["count"], dtype="float64")
+        res._mean = numpy.asarray(moments["mean"], dtype="float64")
+        res._m2 = numpy.asarray(moments["m2"], dtype="float64")
+        return res
+
+    def to_dict(self):
+        return {"count": self._count.tolist(),
+                "mean": self._mean.tolist(),
+                "m2": self._m2.tolist()}
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        mean = self._mean.copy()
+        mean[self._count == 0] = numpy.nan
+        return mean
+
+    @property
+    def std(self):
+        """
+        The population standard deviation of every feature, i.e. the same
+        as 'numpy.nanstd' over all blocks at once.
+        """
+
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            return numpy.sqrt(self._m2 / self._count)
+
+    def update(self, values):
+        """
+        Add a block of cells.
+
+        :param values: an array of cells x features
+        :type values: numpy.ndarray
+        """
+
+        size = FeatureMoments._block_size_
+        for i in range(0, len(values), size):
+            self._update(values[i:i + size])
+        return self
+
+    def _update(self, values):
+        # column-major, such that every feature is summed like a single column
+        values = numpy.asfortranarray(values)
+        valid = numpy.isfinite(values)
+        count = valid.sum(axis=0).astype("float64")
+        total = numpy.where(valid, values, 0).sum(axis=0)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            mean = numpy.where(count > 0, total / count, 0)
+        m2 = (numpy.where(valid, values - mean, 0) ** 2).sum(axis=0)
+        self._combine(count, mean, m2)
+
+    def merge(self, other):
+        """
+        Add the moments of another set of blocks.
+
+        :param other: the moments of the other set of blocks
+        :type other: FeatureMoments
+        """
+
+        self._combine(other._count, other._mean, other._m2)
+        return self
+
+    def _combine(self, count, mean, m2):
+        # pairwise update of Chan et al. which is exact for any partition
+        n = self._count + count
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            delta = mean - self._mean
+            self._mean = numpy.where(
+              n > 0, self._mean + delta * count / n, 0)
+            self._m2 = numpy.where(
+              n > 0, self._m2 + m2 + delta ** 2 * self._count * count / n, 0)
+        self._count = n
@@ -23,17 +23,25 @@ import logging
 
 import enforce
 import numpy
+import pandas
 
 from rnaiutilities.data_set import DataSet
-from rnaiutilities.globals import BSCORE, ZSCORE, LOESS, NONE
+from rnaiutilities.globals import BSCORE, ZSCORE, LOESS, NONE, WELL
+from rnaiutilities.normalization.moments import FeatureMoments
+from rnaiutilities.normalization.spatial import well_positions, \
+    median_polish, loess_surface
+from rnaiutilities.normalization.well_statistics import WellStatistics
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
 class Normalizer:
-    _nf_ = [ZSCORE, NONE]
+    _nf_ = [BSCORE, ZSCORE, LOESS, NONE]
     _normalisations_ = [BSCORE, ZSCORE, LOESS, NONE]
+    # number of values of the feature columns that are normalized as one 2D
+    # array, such that batches stay in cache and at most a batch is copied
+    _batch_size_ = 2 ** 18
 
     def __init__(self, *args):
         """
@@ -46,6 +54,10 @@ class Normalizer:
 
         self._normalize = []
         self._skip = []
+        # masks of columns that are normalized, one for every column set
+        self._masks = {}
+        # pooled feature statistics over several plates for z-scoring
+        self._statistics = None
         if args:
             self.set_normalization(*args)
 
@@ -61,6 +73,7 @@ class Normalizer:
         """
 
         self._skip = skip_features
+        self._masks = {}
         self._normalize = []
         if not args or args is None:
             return
@@ -82,40 +95,420 @@ class Normalizer:
               .format("/".join(Normalizer._nf_)))
 
     @enforce.runtime_validation
-    def normalize_plate(self, data: DataSet):
+    def normalize_plate(self, data: DataSet, reference=None):
         """
         Normalize a plate.
 
         :param data: the data to normalize
         :type data: DataSet
+        :param reference: a mask of the rows that are used for estimating
+         the statistics of the plate or None if all rows are used
+        :type reference: numpy.ndarray
         """
 
-        return self._normalize_plate(data)
+        return self._normalize_plate(data, reference)
 
-    def _normalize_plate(self, df):
-        df = self._replace_inf_with_nan(df, df.feature_columns)
+    def normalizes(self):
+        return len(self._normalize) > 0
+
+    def uses_zscore(self):
+        return ZSCORE in self._normalize
+
+    def zscore_first(self):
+        # z-scores are computed on the raw values of a plate
+        return len(self._normalize) > 0 and self._normalize[0] == ZSCORE
+
+    def zscore_only(self):
+        return self._normalize == [ZSCORE]
+
+    def set_statistics(self, statistics):
+        """
+        Set pooled feature statistics that are used for z-scoring instead of
+        the statistics of the single plate.
+
+        :param statistics: the moments of the feature columns or None to use
+         plate-wise statistics
+        :type statistics: FeatureMoments
+        """
+
+        self._statistics = statistics
+
+    def fit(self, data):
+        """
+        Estimate the parameters of the normalisation methods on a data set,
+        e.g. on a sample of the rows of a plate, such that other rows of the
+        plate can be normalized using `transform`. Every method is estimated
+        on the data normalized by the previous methods.
+
+        :param data: the data to estimate the parameters from
+        :type data: DataSet
+        :return: returns a list of parameters, one for every method
+        :rtype: list
+        """
+
+        values = self._feature_block(data)
+        mask = self._mask(data.feature_columns)
+        wells = data.data[WELL].values
+        params = []
+        for normal in self._normalize:
+            params.append(self._fit(normal, values, mask, wells, None))
+            values = self._apply(normal, values, mask, wells, params[-1])
+        return params
+
+    def fit_wells(self, statistics, feature_columns):
+        """
+        Estimate the parameters of the normalisation methods on the
+        statistics of the wells of an entire plate instead of on its rows,
+        such that rows of a plate are normalized the same way whichever rows
+        of it are read. Every method is estimated on the statistics
+        normalized by the previous methods.
+
+        :param statistics: the statistics of the wells of the plate
+        :type statistics: WellStatistics
+        :param feature_columns: the names of the columns of the statistics
+        :type feature_columns: list(str)
+        :return: returns a list of parameters, one for every method
+        :rtype: list
+        """
+
+        mask = self._mask(feature_columns)
+        params = []
+        for normal in self._normalize:
+            param = None
+            if mask.any():
+                f = self.__getattribute__("_fit_wells_" + normal)
+                param = f(statistics, mask)
+            params.append(param)
+            statistics = self._apply_wells(normal, statistics, mask, param)
+        return params
+
+    def transform(self, data, params):
+        """
+        Normalize a data set using parameters that have been estimated with
+        `fit`.
+
+        :param data: the data to normalize
+        :type data: DataSet
+        :param params: the parameters of the normalisation methods
+        :type params: list
+        :return: returns the normalized data
+        :rtype: DataSet
+        """
+
+        values = self._feature_block(data)
+        mask = self._mask(data.feature_columns)
+        wells = data.data[WELL].values
+        for normal, param in zip(self._normalize, params):
+            values = self._apply(normal, values, mask, wells, param)
+        data.data[data.feature_columns] = values
+        return data
+
+    def accumulate(self, df, statistics):
+        """
+        Add the feature columns of a plate to pooled statistics. Methods that
+        are applied before 'zscore' are applied to the plate first, such
+        that the statistics match the values that are z-scored.
+
+        :param df: the data of the plate
+        :type df: DataSet
+        :param statistics: the moments of the feature columns or None
+        :type statistics: FeatureMoments
+        :return: returns the updated statistics
+        :rtype: FeatureMoments
+        """
+
+        values = self._feature_block(df)
+        mask = self._mask(df.feature_columns)
+        wells = df.data[WELL].values
+        previous = self._normalize[:self._normalize.index(ZSCORE)] \
+            if ZSCORE in self._normalize else self._normalize
+        for normal in previous:
+            param = self._fit(normal, values, mask, wells, None)
+            values = self._apply(normal, values, mask, wells, param)
+        if statistics is None:
+            statistics = FeatureMoments(values.shape[1])
+        return statistics.update(values)
+
+    def _normalize_plate(self, df, reference):
+        values = self._feature_block(df)
+        self.normalize_values(
+          values, df.feature_columns, df.data[WELL].values, reference)
+        df.data[df.feature_columns] = values
+        return df
+
+    def normalize_values(self, values, feature_columns, wells,
+                         reference=None, params=None):
+        """
+        Normalize the feature columns of a plate in place, such that the
+        feature block of a plate does not need to be copied into and out of
+        a data frame.
+
+        :param values: a column-major float64 array of rows x feature columns
+        :type values: numpy.ndarray
+        :param feature_columns: the names of the columns of *values*
+        :type feature_columns: list(str)
+        :param wells: the well of every row
+        :type wells: numpy.ndarray
+        :param reference: a mask of the rows that are used for estimating
+         the statistics of the plate or None if all rows are used
+        :type reference: numpy.ndarray
+        :param params: the parameters of the methods that have been estimated
+         with `fit_wells` or None if they are estimated on the values
+        :type params: list
+        :return: returns the normalized values
+        :rtype: numpy.ndarray
+        """
+
+        values = self._replace_inf_with_nan(values)
+        mask = self._mask(feature_columns)
         # do normalisations on the fly
         logger.info("Normalizing plate using {}.".
                     format("/".join(self._normalize)))
-        for normal in self._normalize:
-            f = self.__getattribute__("_" + normal)
-            df, _ = f(df, None, df.feature_columns)
-        return df
+        for i, normal in enumerate(self._normalize):
+            param = self._fit(normal, values, mask, wells, reference) \
+                if params is None else params[i]
+            values = self._apply(normal, values, mask, wells, param)
+        return values
+
+    def _fit(self, normal, values, mask, wells, reference):
+        # estimate the parameters of a method on the reference rows
+        if not mask.any():
+            return None
+        f = self.__getattribute__("_fit_" + normal)
+        return f(values, mask, wells, reference)
+
+    def _apply(self, normal, values, mask, wells, param):
+        if param is None:
+            return values
+        f = self.__getattribute__("_apply_" + normal)
+        return f(values, mask, wells, param)
+
+    def _apply_wells(self, normal, statistics, mask, param):
+        # the medians and means of the wells are normalized like values of
+        # the wells and the sums of squared deviations are divided by the
+        # square of the divisor of the method
+        if param is None:
+            return statistics
+        wells = statistics.wells
+        median = self._apply(
+          normal, numpy.array(statistics.median, order="F"), mask, wells,
+          param)
+        mean = self._apply(
+          normal, numpy.array(statistics.mean, order="F"), mask, wells, param)
+        m2 = statistics.m2.copy()
+        m2[:, mask] /= self._divisor(normal, param) ** 2
+        return WellStatistics(wells, statistics.count, mean, m2, median)
 
     @staticmethod
-    def _replace_inf_with_nan(df, feature_columns):
-        for col in feature_columns:
-            idx = numpy.isinf(df.data[col])
-            df.data.loc[idx, col] = numpy.nan
-        return df
+    def _divisor(normal, param):
+        # the constant by which a method divides every feature
+        if normal == BSCORE:
+            return param[3] + 0.00000001
+        if normal == ZSCORE:
+            return param[1] + 0.00000001
+        return 1
 
-    def _zscore(self, df, well_df, feature_columns):
+    def _feature_block(self, df):
+        # normalize the feature columns as a single 2D block. the block is
+        # column-major such that column statistics are computed on
+        # contiguous memory
+        values = numpy.asfortranarray(
+          df.data[df.feature_columns].values, dtype="float64")
+        return self._replace_inf_with_nan(values)
+
+    def _mask(self, feature_columns):
+        key = tuple(feature_columns)
+        if key not in self._masks:
+            self._masks[key] = numpy.array(
+              [all(skip not in col.lower() for skip in self._skip)
+               for col in feature_columns], dtype=bool)
+        return self._masks[key]
+
+    @staticmethod
+    def _replace_inf_with_nan(values):
+        columns = numpy.ones(values.shape[1], dtype=bool)
+        for _, cols in Normalizer._batches(columns, len(values)):
+            block = values[:, cols[0]:cols[-1] + 1]
+            block[numpy.isinf(block)] = numpy.nan
+        return values
+
+    def _fit_zscore(self, values, mask, wells, reference):
+        logger.info("\tstandardizing feature columns.")
+        if self._statistics is not None:
+            return self._statistics.mean[mask], self._statistics.std[mask]
+        mea, sd = numpy.empty(mask.sum()), numpy.empty(mask.sum())
+        for i, cols in self._batches(mask, len(values)):
+            block = self._block(values, cols)
+            if reference is not None:
+                # column-major, such that the columns are summed like single
+                # columns
+                block = numpy.asfortranarray(block[reference])
+                mea[i:i + len(cols)] = numpy.nanmean(block, axis=0)
+                sd[i:i + len(cols)] = numpy.nanstd(block, axis=0)
+            else:
+                # the same moments as if the plate was streamed in chunks
+                moments = FeatureMoments(len(cols)).update(block)
+                mea[i:i + len(cols)] = moments.mean
+                sd[i:i + len(cols)] = moments.std
+        return mea, sd
+
+    def _fit_wells_zscore(self, statistics, mask):
         logger.info("\tstandardizing feature columns.")
-        for col in feature_columns:
-            if all(skip not in col.lower() for skip in self._skip):
-                mea = numpy.nanmean(df.data[col])
-                sd = numpy.nanstd(df.data[col])
-                new_col_vals = (df.data[col] - mea) / (sd + 0.00000001)
-                new_col_vals[numpy.isinf(new_col_vals)] = numpy.nan
-                df.data[col] = new_col_vals
-        return df, well_df
+        moments = self._statistics
+        if moments is None:
+            moments = statistics.moments()
+        return moments.mean[mask], moments.std[mask]
+
+    @staticmethod
+    def _apply_zscore(values, mask, wells, param):
+        mea, sd = param
+        for i, cols in Normalizer._batches(mask, len(values)):
+            block = Normalizer._block(values, cols)
+            block -= mea[i:i + len(cols)]
+            block /= sd[i:i + len(cols)] + 0.00000001
+            block[numpy.isinf(block)] = numpy.nan
+            Normalizer._store(values, cols, block)
+        return values
+
+    @staticmethod
+    def _batches(mask, n_rows):
+        # the normalized columns in batches of at most _batch_size_ values,
+        # together with the position of the first column of a batch among
+        # the normalized columns
+        columns = numpy.flatnonzero(mask)
+        size = max(1, Normalizer._batch_size_ // max(n_rows, 1))
+        for i in range(0, len(columns), size):
+            yield i, columns[i:i + size]
+
+    @staticmethod
+    def _block(values, cols):
+        # consecutive columns are a view of the column-major values, other
+        # columns are copied
+        if cols[-1] - cols[0] + 1 == len(cols):
+            return values[:, cols[0]:cols[-1] + 1]
+        return values[:, cols]
+
+    @staticmethod
+    def _store(values, cols, block):
+        if not numpy.may_share_memory(values, block):
+            values[:, cols] = block
+
+    @staticmethod
+    def _fit_bscore(values, mask, wells, reference):
+        logger.info("\tcomputing B-scores of feature columns.")
+        return Normalizer._bscore(
+          Normalizer._well_medians(values, mask, wells, reference))
+
+    @staticmethod
+    def _fit_wells_bscore(statistics, mask):
+        logger.info("\tcomputing B-scores of feature columns.")
+        return Normalizer._bscore(Normalizer._well_grid(
+          statistics.wells, statistics.median[:, mask]))
+
+    @staticmethod
+    def _bscore(medians):
+        # median polish of the well medians of a plate
+        if medians is None:
+            return None
+        _, rows, cols, agg = medians
+        grid = numpy.full((rows.max() + 1, cols.max() + 1, agg.shape[1]),
+                          numpy.nan)
+        grid[rows, cols] = agg
+        overall, row, col = median_polish(grid)
+        resid = agg - (overall + row[rows] + col[cols])
+        with numpy.errstate(invalid="ignore"):
+            mad = 1.4826 * numpy.nanmedian(
+              numpy.abs(resid - numpy.nanmedian(resid, axis=0)), axis=0)
+        return overall, row, col, mad
+
+    @staticmethod
+    def _apply_bscore(values, mask, wells, param):
+        overall, row, col, mad = param
+        codes, names = pandas.factorize(wells)
+        rows, cols = well_positions(names)
+        fit = overall + Normalizer._effects(row, rows) + \
+            Normalizer._effects(col, cols)
+        for i, batch in Normalizer._batches(mask, len(values)):
+            j = slice(i, i + len(batch))
+            block = Normalizer._block(values, batch)
+            block -= fit[codes, j]
+            block /= mad[j] + 0.00000001
+            block[numpy.isinf(block)] = numpy.nan
+            Normalizer._store(values, batch, block)
+        return values
+
+    @staticmethod
+    def _effects(effects, idx):
+        # row/column effects of wells, zero for rows/columns outside the grid
+        out = numpy.zeros((len(idx), effects.shape[1]))
+        inside = (idx >= 0) & (idx < effects.shape[0])
+        out[inside] = effects[idx[inside]]
+        return out
+
+    @staticmethod
+    def _fit_loess(values, mask, wells, reference):
+        logger.info("\tremoving LOESS spatial trend of feature columns.")
+        return Normalizer._loess(
+          Normalizer._well_medians(values, mask, wells, reference))
+
+    @staticmethod
+    def _fit_wells_loess(statistics, mask):
+        logger.info("\tremoving LOESS spatial trend of feature columns.")
+        return Normalizer._loess(Normalizer._well_grid(
+          statistics.wells, statistics.median[:, mask]))
+
+    @staticmethod
+    def _loess(medians):
+        # LOESS surface of the well medians of a plate
+        if medians is None:
+            return None
+        names, rows, cols, agg = medians
+        fit = loess_surface(rows, cols, agg)
+        with numpy.errstate(invalid="ignore"):
+            center = numpy.nanmedian(agg, axis=0)
+        return pandas.Index(names), fit, center
+
+    @staticmethod
+    def _apply_loess(values, mask, wells, param):
+        names, fit, center = param
+        # wells that have not been fitted are not corrected, i.e. the
+        # appended center is subtracted
+        fit = numpy.vstack([fit, center])
+        codes = names.get_indexer(wells)
+        for i, batch in Normalizer._batches(mask, len(values)):
+            j = slice(i, i + len(batch))
+            block = Normalizer._block(values, batch)
+            block -= fit[codes, j]
+            block += center[j]
+            Normalizer._store(values, batch, block)
+        return values
+
+    @staticmethod
+    def _well_medians(values, mask, wells, reference):
+        """
+        Aggregate the masked feature columns of a plate to well medians. If
+        a mask of reference rows is given, only these rows are aggregated.
+
+        :return: returns the names, rows and columns of the wells and an
+         array of wells x features of medians, or None if the well positions
+         cannot be parsed
+        """
+
+        codes, names = pandas.factorize(wells)
+        block, groups = values[:, mask], codes
+        if reference is not None:
+            block, groups = block[reference], codes[reference]
+        agg = pandas.DataFrame(block).groupby(groups).median() \
+            .reindex(range(len(names))).values
+        return Normalizer._well_grid(names, agg)
+
+    @staticmethod
+    def _well_grid(names, agg):
+        # the positions of the wells of the medians on the plate or None if
+        # the well positions cannot be parsed
+        rows, cols = well_positions(names)
+        if (rows < 0).any():
+            logger.warning("\tcould not parse well positions {}, skipping."
+                           .format(", ".join(map(str, names[rows < 0]))))
+            return None
+        return names, rows, cols, agg
@@ -0,0 +1,132 @@
+# Copyright (C) 2016 Simon Dirmeier
+#
+# This file is part of rnaiutilities.
+#
+# rnaiutilities is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rnaiutilities is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rnaiutilities. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author = 'Simon Dirmeier'
+# @email = 'simon.dirmeier@bsse.ethz.ch'
+
+"""
+Module for estimating spatial effects on the well grid of a plate. All
+functions work on well-wise aggregates of all features at once, i.e. on
+arrays with one column per feature.
+"""
+
+import re
+import warnings
+
+import numpy
+
+__well_regex__ = re.compile(r"^([a-z])(\d+)$")
+
+
+def well_positions(wells):
+    """
+    Compute the row and column indexes of wells on a plate.
+
+    :param wells: a list of well names, such as 'a01'
+    :return: returns an integer array of rows and an integer array of
+     columns. Wells that cannot be parsed have row and column -1
+    """
+
+    rows = numpy.full(len(wells), -1, dtype="int64")
+    cols = numpy.full(len(wells), -1, dtype="int64")
+    for i, well in enumerate(wells):
+        mat = __well_regex__.match(str(well).lower())
+        if mat is not None:
+            rows[i] = ord(mat.group(1)) - ord("a")
+            cols[i] = int(mat.group(2)) - 1
+    return rows, cols
+
+
+def median_polish(grid, max_iter=10, eps=0.01):
+    """
+    Tukey's median polish of a plate grid for several features at once.
+
+    :param grid: an array of dimension rows x columns x features with NaN
+     for missing wells
+    :param max_iter: maximum number of iterations
+    :param eps: relative convergence tolerance of the sum of absolute
+     residuals
+    :return: returns the overall effects (features), the row effects
+     (rows x features) and the column effects (columns x features)
+    """
+
+    n_row, n_col, n_feat = grid.shape
+    overall = numpy.zeros(n_feat)
+    row = numpy.zeros((n_row, n_feat))
+    col = numpy.zeros((n_col, n_feat))
+    resid = grid.copy()
+    old_sum = numpy.inf
+    with warnings.catch_warnings():
+        # rows or columns without any wells have all-NaN medians
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for _ in range(max_iter):
+            rmed = numpy.nan_to_num(numpy.nanmedian(resid, axis=1))
+            resid -= rmed[:, None, :]
+            row += rmed
+            delta = numpy.nan_to_num(numpy.nanmedian(col, axis=0))
+            col -= delta
+            overall += delta
+
+            cmed = numpy.nan_to_num(numpy.nanmedian(resid, axis=0))
+            resid -= cmed[None, :, :]
+            col += cmed
+            delta = numpy.nan_to_num(numpy.nanmedian(row, axis=0))
+            row -= delta
+            overall += delta
+
+            new_sum = numpy.nansum(numpy.abs(resid))
+            if new_sum == 0 or abs(new_sum - old_sum) <= eps * new_sum:
+                break
+            old_sum = new_sum
+    return overall, row, col
+
+
+def loess_surface(rows, cols, values, span=0.3):
+    """
+    Fit a local linear regression (LOESS) surface over the well grid for
+    several features at once and evaluate it at the wells.
+
+    :param rows: the row index of every well
+    :param cols: the column index of every well
+    :param values: an array of wells x features with NaN for missing values
+    :param span: the fraction of wells that are used for every local fit
+    :return: returns an array of wells x features of fitted values
+    """
+
+    n_well, n_feat = values.shape
+    pos = numpy.column_stack([rows, cols]).astype("float64")
+    x = numpy.column_stack([numpy.ones(n_well), pos])
+    # tricube weights of every well (cols) for the fit at every well (rows)
+    dist = numpy.sqrt(
+      ((pos[:, None, :] - pos[None, :, :]) ** 2).sum(axis=2))
+    k = min(n_well, max(3, int(numpy.ceil(span * n_well))))
+    bandwidth = numpy.sort(dist, axis=1)[:, k - 1] + 1e-8
+    weights = numpy.clip(1 - (dist / bandwidth[:, None]) ** 3, 0, 1) ** 3
+
+    # missing values get zero weight, so the normal equations differ for
+    # every feature: A = X' W X and b = X' W y for every well and feature
+    valid = ~numpy.isnan(values)
+    y = numpy.where(valid, values, 0)
+    xx = x[:, :, None] * x[:, None, :]
+    a = weights @ (valid[:, :, None] * xx.reshape(n_well, 1, 9)).reshape(
+      n_well, n_feat * 9)
+    b = weights @ (y[:, :, None] * x[:, None, :]).reshape(
+      n_well, n_feat * 3)
+    a = a.reshape(n_well, n_feat, 3, 3) + 1e-8 * numpy.eye(3)
+    b = b.reshape(n_well, n_feat, 3, 1)
+    beta = numpy.linalg.solve(a, b)[..., 0]
+    return numpy.einsum("ti,tfi->tf", x, beta)
@@ -0,0 +1,169 @@
+# Copyright (C) 2016 Simon Dirmeier
+#
+# This file is part of rnaiutilities.
+#
+# rnaiutilities is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rnaiutilities is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rnaiutilities. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author = 'Simon Dirmeier'
+# @email = 'simon.dirmeier@bsse.ethz.ch'
+
+
+import numpy
+import pandas
+
+from rnaiutilities.normalization.moments import FeatureMoments
+
+
+class WellStatistics:
+    """
+    Per-well counts, means, sums of squared deviations and medians of the
+    features of a plate. B-scores and LOESS fits are estimated on the well
+    medians and z-scores on the moments, such that the normalisation of an
+    entire plate can be estimated without reading its cells, e.g. if only
+    the rows of some wells are read.
+
+    Every normalisation shifts the values of a well and divides every
+    feature by a constant, such that the statistics of a normalized plate
+    follow from the statistics of the plate.
+    """
+
+    def __init__(self, wells, count, mean, m2, median):
+        """
+        Constructor for WellStatistics.
+
+        :param wells: the names of the wells
+        :type wells: list(str)
+        :param count: an array of wells x features of counts
+        :type count: numpy.ndarray
+        :param mean: an array of wells x features of means
+        :type mean: numpy.ndarray
+        :param m2: an array of wells x features of sums of squared deviations
+        :type m2: numpy.ndarray
+        :param median: an array of wells x features of medians
+        :type median: numpy.ndarray
+        """
+
+        self._wells = numpy.asarray(wells, dtype=object)
+        self._count = numpy.asarray(count, dtype="float64")
+        self._mean = numpy.asarray(mean, dtype="float64")
+        self._m2 = numpy.asarray(m2, dtype="float64")
+        self._median = numpy.asarray(median, dtype="float64")
+
+    @staticmethod
+    def from_values(values, wells):
+        """
+        Compute the statistics of the cells of a plate. NaNs and infinite
+        values are ignored feature-wise.
+
+        :param values: an array of cells x features
+        :type values: numpy.ndarray
+        :param wells: the well of every cell
+        :type wells: numpy.ndarray
+        :return: returns the statistics of the wells of the cells
+        :rtype: WellStatistics
+        """
+
+        codes, names = pandas.factorize(wells)
+        frame = pandas.DataFrame(values).replace(
+          [numpy.inf, -numpy.inf], numpy.nan)
+        grouped = frame.groupby(codes)
+        wells = range(len(names))
+        count = grouped.count().reindex(wells).values.astype("float64")
+        mean = grouped.mean().reindex(wells).values
+        m2 = grouped.var(ddof=0).reindex(wells).values * count
+        median = grouped.median().reindex(wells).values
+        # wells without values have zero moments like FeatureMoments
+        empty = count == 0
+        mean[empty], m2[empty] = 0, 0
+        return WellStatistics(names, count, mean, m2, median)
+
+    @staticmethod
+    def concat(statistics):
+        """
+        Concatenate the statistics of blocks of features of the same cells.
+
+        :param statistics: the statistics of the blocks of features
+        :type statistics: list(WellStatistics)
+        :return: returns the statistics of all features
+        :rtype: WellStatistics
+        """
+
+        return WellStatistics(
+          statistics[0].wells,
+          *[numpy.hstack([getattr(s, k) for s in statistics])
+            for k in ["count", "mean", "m2", "median"]])
+
+    @staticmethod
+    def from_dict(statistics):
+        """
+        Create well statistics that have been stored with `to_dict`.
+
+        :param statistics: a dictionary of the wells and of lists of
+         counts, means, sums of squared deviations and medians, one list of
+         features for every well
+        :type statistics: dict
+        :return: returns the well statistics
+        :rtype: WellStatistics
+        """
+
+        return WellStatistics(
+          statistics["wells"], statistics["count"], statistics["mean"],
+          statistics["m2"], statistics["median"])
+
+    def to_dict(self):
+        return {"wells": self._wells.tolist(),
+                "count": self._count.tolist(),
+                "mean": self._mean.tolist(),
+                "m2": self._m2.tolist(),
+                "median": self._median.tolist()}
+
+    @property
+    def wells(self):
+        return self._wells
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def m2(self):
+        return self._m2
+
+    @property
+    def median(self):
+        return self._median
+
+    def moments(self):
+        """
+        Pool the moments of the wells, i.e. the moments of all cells of the
+        plate.
+
+        :return: returns the moments of the features
+        :rtype: FeatureMoments
+        """
+
+        valid = self._count > 0
+        count = self._count.sum(axis=0)
+        total = numpy.where(valid, self._count * self._mean, 0).sum(axis=0)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            mean = numpy.where(count > 0, total / count, 0)
+        m2 = numpy.where(
+          valid, self._m2 + self._count * (self._mean - mean) ** 2, 0) \
+            .sum(axis=0)
+        return FeatureMoments.from_dict(
+          {"count": count, "mean": mean, "m2": m2})
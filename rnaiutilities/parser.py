@@ -45,6 +45,20 @@ logger = mp.log_to_stderr()
 logger.setLevel(logging.INFO)
 
 
+# the plate parser of a worker process, which is created once per worker by
+# the initializer of the pool instead of being pickled into every task
+_worker_parser = None
+
+
+def _init_parse_worker(config):
+    global _worker_parser
+    _worker_parser = _PlateParser(config)
+
+
+def _parse_in_worker(plate):
+    return plate, _worker_parser.parse(plate)
+
+
 class Parser:
     """
     Class for parsing a folder of plates containing matlab files for the
@@ -70,62 +84,32 @@ class Parser:
         self._plate_folder_list = PlateFolderList(
           config.plate_id_file, config.plate_regex)
 
-        # the actual parser
-        self._parser = PlateFilesParser()
-        # the actual writer of parsed data
-        self._writer = PlateWriter(config.layout_file)
-
     def parse(self):
         """
         Parses the plate file sets into raw tsv files.
         """
 
         exps = list(self._plate_folder_list.folders)
-        # use globals vars for process pool
+        # workers build their parser and writer once in the initializer
         if self._config.multi_processing:
-            # number of cores we are using
-            n_cores = mp.cpu_count() - 1
+            n_cores = self._config.workers
             logger.info("Going parallel with " + str(n_cores) + " cores!")
-            pool = mp.Pool(processes=n_cores)
-            _ = pool.map(func=self._parse, iterable=exps)
+            pool = mp.Pool(processes=n_cores, initializer=_init_parse_worker,
+                           initargs=(self._config,),
+                           maxtasksperchild=self._config.tasks_per_child)
+            results = pool.imap_unordered(_parse_in_worker, exps)
+        else:
+            parser = _PlateParser(self._config)
+            pool, results = None, ((x, parser.parse(x)) for x in exps)
+        failed = [plate for plate, ret in results if ret != 0]
+        if pool is not None:
             pool.close()
             pool.join()
-        else:
-            for x in exps:
-                self._parse(x)
+        if failed:
+            logger.warning("Could not parse {} of {} plates: {}".format(
+              len(failed), len(exps), ", ".join(map(str, failed))))
         logger.info("All's well that ends well")
 
-    def _parse(self, plate):
-        # Parse the files of a single plate folder as tsv
-        try:
-            platefilesets = PlateFileSets(
-              self._plate_folder + "/" + plate, self._output_path)
-            if len(platefilesets) > 1:
-                raise ValueError("Found multiple plate identifiers.")
-            return self._parse_plate_file_sets(platefilesets)
-        except Exception as ex:
-            logger.error("Found error parsing: " + str(plate) + ". " +
-                         "Error:" + str(ex))
-            return 1
-
-    def _parse_plate_file_sets(self, platefilesets):
-        for platefileset in platefilesets:
-            self._parse_plate_file_set(platefileset)
-        return 0
-
-    def _parse_plate_file_set(self, platefileset):
-        # create a list of relevant files for the plateset
-        fls = usable_feature_files(platefileset, USABLE_FEATURES)
-        # if all the files exist, we just skip the creation of the files
-        if any(not Path(x).exists() for x in fls):
-            logger.info("Doing: " + " ".join(platefileset.meta))
-            # parse and write the plate file sets
-            pfs, features, mapping = self._parser.parse(platefileset)
-            self._writer.write(pfs, features, mapping)
-        else:
-            logger.info(" ".join(map(str, platefileset.meta)) +
-                        " already exists. Skipping.")
-
     def parse_statistics(self):
         """
         Computes parsing statistics.
@@ -133,7 +117,7 @@ class Parser:
 
         ParseStatistics(
           self._plate_folder_list, self._plate_folder,
-          self._output_path).statistics()
+          self._output_path, self._config.output_format).statistics()
 
     def download_statistics(self):
         """
@@ -152,3 +136,70 @@ class Parser:
 
         FeatureSetStatistics(
           self._plate_folder_list, self._plate_folder, outfile).statistics()
+
+
+class _PlateParser:
+    """
+    Class for parsing and writing the plate file sets of single plate
+    folders.
+    """
+
+    def __init__(self, config):
+        """
+        Constructor for _PlateParser.
+
+        :param config: a configuration for file parsing
+        :type config: Config
+        """
+
+        self._config = config
+        self._plate_folder = config.plate_folder
+        self._output_path = config.output_path
+        # the actual parser
+        self._parser = PlateFilesParser(
+          config.ragged_features, config.feature_dtype, config.file_threads)
+        # the actual writer of parsed data
+        self._writer = PlateWriter(config.layout_file, config.output_format)
+
+    def parse(self, plate):
+        """
+        Parse the files of a single plate folder.
+
+        :param plate: the name of the plate folder
+        :type plate: str
+        :return: returns 0 if the plate has been parsed and 1 otherwise
+        :rtype: int
+        """
+
+        try:
+            platefilesets = PlateFileSets(
+              self._plate_folder + "/" + plate, self._output_path)
+            if len(platefilesets) > 1:
+                raise ValueError("Found multiple plate identifiers.")
+            return self._parse_plate_file_sets(platefilesets)
+        except Exception as ex:
+            logger.error("Found error parsing: " + str(plate) + ". " +
+                         "Error:" + str(ex))
+            return 1
+
+    def _parse_plate_file_sets(self, platefilesets):
+        for platefileset in platefilesets:
+            self._parse_plate_file_set(platefileset)
+        return 0
+
+    def _parse_plate_file_set(self, platefileset):
+        # create a list of relevant files for the plateset
+        fls = usable_feature_files(
+          platefileset, USABLE_FEATURES, self._config.output_format)
+        # if all the files exist, we just skip the creation of the files
+        if any(not Path(x).exists() for x in fls):
+            logger.info("Doing: " + " ".join(platefileset.meta))
+            # write every feature group as soon as its files are parsed
+            mapping = self._parser.parse_mapping(platefileset)
+            for feature_group, features in \
+                    self._parser.parse_feature_groups(platefileset):
+                self._writer.write_feature_group(
+                  platefileset, feature_group, features, mapping)
+        else:
+            logger.info(" ".join(map(str, platefileset.meta)) +
+                        " already exists. Skipping.")
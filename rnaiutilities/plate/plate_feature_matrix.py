@@ -19,26 +19,39 @@
 # @email = 'simon.dirmeier@bsse.ethz.ch'
 
 
-from numpy import shape
+import numpy
+from numpy import shape, Infinity
+
+from rnaiutilities.utility.array import ragged_to_dense
 
 
 class FeatureMatrix:
     """
     Class that stores the features for a single matlab files
 
+    The features are either stored as a matrix of images x cells that is
+    padded with Infinity to the maximal number of cells of an image, or as a
+    ragged matrix, i.e. the cells of all images in one flat array and the
+    offsets of the images, which does not need to pad images with few cells.
+    Consumers should use `cells` and `take`, which work on both without
+    creating the padded matrix.
     """
 
     def __init__(self, mat, n_images, n_max_cells_count,
-                 filename, n_cells_per_image, featurename):
+                 filename, n_cells_per_image, featurename, offsets=None):
         """
-        :param mat: the parsed matrix
+        :param mat: the parsed matrix, or the concatenated values of all
+         images if *offsets* is given
         :param n_images: the number of images * wells (this usually is 3456).
         :param n_max_cells_count: the max number of cells on the well
         :param filename: name of the feature file
         :param n_cells_per_image: the number of cells per image
+        :param offsets: the offsets of the images in the concatenated values
+         or None if *mat* is a matrix of images x cells
 
         """
         self._mat = mat
+        self._offsets = offsets
         self._n_images = n_images
         self._n_max_cells_count = n_max_cells_count
         self._filename = filename
@@ -46,8 +59,12 @@ class FeatureMatrix:
         self._featurename = featurename.lower()
         self._feature_group, self._short_feature_name =\
             self._featurename.split(".")[0:2]
-        assert (shape(self._mat)[0] == self._n_images)
-        assert (shape(self._mat)[1] == self._n_max_cells_count)
+        if offsets is None:
+            assert (shape(self._mat)[0] == self._n_images)
+            assert (shape(self._mat)[1] == self._n_max_cells_count)
+        else:
+            assert (len(self._offsets) == self._n_images + 1)
+            assert (len(self._mat) == self._offsets[-1])
 
     def __repr__(self):
         return self.__str__()
@@ -56,13 +73,72 @@ class FeatureMatrix:
         return "Feature " + self._featurename
 
     @property
-    def max_cells(self):
-        return self._n_max_cells_count
+    def n_images(self):
+        return self._n_images
 
     @property
     def values(self):
+        # ragged matrices are padded with Infinity whenever the matrix of
+        # images x cells is needed, but keep being stored compactly
+        if self._offsets is not None:
+            return ragged_to_dense(
+              self._mat, numpy.diff(self._offsets), Infinity)
         return self._mat
 
+    def cells(self, image, n):
+        """
+        Get the values of the first *n* cells of an image, but not more than
+        the maximal number of cells of an image. Like in the padded matrix,
+        cells beyond the number of cells of the image are Infinity.
+
+        :param image: the index of the image
+        :type image: int
+        :param n: the number of cells
+        :type n: int
+        :return: returns the values of the cells
+        :rtype: numpy.ndarray
+        """
+
+        if image >= self._n_images:
+            return self._mat[:0].ravel()
+        if self._offsets is None:
+            return self._mat[image, :n]
+        start, end = self._offsets[image], self._offsets[image + 1]
+        row = self._mat[start:min(end, start + n)]
+        pad = min(n, self._n_max_cells_count) - len(row)
+        if pad > 0:
+            row = numpy.concatenate(
+              [row, numpy.full(pad, Infinity, dtype=row.dtype)])
+        return row
+
+    def take(self, images, cells):
+        """
+        Get the values of single cells, given by the index of their image and
+        their index within the image. Cells that lie outside of the matrix
+        are NaN. The values have the float type of the matrix, e.g. float32.
+
+        :param images: the image index of every cell
+        :type images: numpy.ndarray
+        :param cells: the index of every cell within its image
+        :type cells: numpy.ndarray
+        :return: returns an array of the values
+        :rtype: numpy.ndarray
+        """
+
+        col = numpy.full(len(images), numpy.nan, dtype=self._mat.dtype)
+        inside = (images < self._n_images) & \
+            (cells < self._n_max_cells_count)
+        img, obj = images[inside], cells[inside]
+        if self._offsets is None:
+            col[inside] = self._mat[img, obj]
+            return col
+        # cells beyond the number of cells of their image are padding
+        own = obj < numpy.diff(self._offsets)[img]
+        vals = numpy.full(len(img), Infinity, dtype=self._mat.dtype)
+        vals[own] = self._mat[self._offsets[img[own]] + obj[own]]
+        col[inside] = vals
+        return col
+
     @property
     def featurename(self):
         return self._featurename
@@ -19,7 +19,9 @@
 # @email = 'simon.dirmeier@bsse.ethz.ch'
 
 
+import collections
 import logging
+from multiprocessing.pool import ThreadPool
 
 import enforce
 import numpy
@@ -27,7 +29,8 @@ import numpy
 from rnaiutilities.plate.plate_feature_matrix import FeatureMatrix
 from rnaiutilities.plate.plate_file_set import PlateFileSet
 from rnaiutilities.plate.plate_sirna_gene_mapping import PlateSirnaGeneMapping
-from rnaiutilities.utility.files import load_matlab
+from rnaiutilities.utility.array import offsets, ragged_to_dense
+from rnaiutilities.utility.files import load_measurement
 
 logger = logging.getLogger(__name__)
 
@@ -39,6 +42,26 @@ class PlateFilesParser:
     Class for parsing single features files as numpy arrays.
     """
 
+    def __init__(self, ragged=False, dtype="float64", threads=1):
+        """
+        Constructor for PlateFilesParser.
+
+        :param ragged: if True, features are stored as the concatenated cells
+         of all images and their offsets, instead of a matrix of images x
+         cells that is padded to the maximal number of cells of an image
+        :type ragged: bool
+        :param dtype: the float type in which features are stored, i.e.
+         'float64' or 'float32'
+        :type dtype: str
+        :param threads: the number of threads that load the feature files of
+         a plate concurrently
+        :type threads: int
+        """
+
+        self._ragged = ragged
+        self._dtype = dtype
+        self._threads = threads
+
     @enforce.runtime_validation()
     def parse(self, pfs: PlateFileSet):
         """
@@ -49,25 +72,72 @@ class PlateFilesParser:
         """
 
         features = self._parse_plate_file_set(pfs)
-        mapping = self._parse_plate_mapping(pfs)
+        mapping = self.parse_mapping(pfs)
         return pfs, features, mapping
 
     def _parse_plate_file_set(self, pfs):
+        return dict(self.parse_feature_groups(pfs))
+
+    def parse_feature_groups(self, pfs):
+        """
+        Parse the feature files of a plate file set and yield every feature
+        group as soon as all of its files have been parsed, such that it can
+        be written while the files of the other groups are still loaded.
+
+        :param pfs: the plate file set to parse
+        :type pfs: PlateFileSet
+        :return: returns a generator of feature groups and their features
+        :rtype: generator(tuple(str, list(FeatureMatrix)))
+        """
+
         logger.info(
           "Parsing plate file set to memory: {}".format(str(pfs.classifier)))
-        features = {}
-        for plate_file in pfs:
-            try:
-                cf = self._parse_file(plate_file)
-                self._add(features, cf, cf.feature_group)
-            except (
-              ValueError, TypeError, AssertionError, FileNotFoundError) as e:
-                logger.error(
-                  "Could not parse: {} -> {}".format(plate_file, str(e)))
-        if len(features) == 0:
+        files = list(pfs)
+        remaining = collections.Counter(
+          self._feature_group(x.featurename) for x in files)
+        features, n_groups = {}, 0
+        for plate_file, cf in self._parse_files(files):
+            feature_group = self._feature_group(plate_file.featurename)
+            if cf is not None:
+                self._add(features, cf, feature_group)
+            remaining[feature_group] -= 1
+            if remaining[feature_group] == 0 and feature_group in features:
+                n_groups += 1
+                yield feature_group, features.pop(feature_group)
+        if n_groups == 0:
             raise ValueError(
               "No files found for platefileset: {}".format(pfs.classifier))
-        return features
+
+    def parse_mapping(self, pfs):
+        """
+        Parse the siRNA/gene mapping of the images of a plate file set.
+
+        :param pfs: the plate file set to parse
+        :type pfs: PlateFileSet
+        :return: returns the mapping of the plate
+        :rtype: PlateSirnaGeneMapping
+        """
+
+        return self._parse_plate_mapping(pfs)
+
+    def _parse_files(self, files):
+        # loading a file is mostly reading and decompressing, such that
+        # threads can overlap and results are not pickled between processes
+        if self._threads <= 1:
+            for plate_file in files:
+                yield self._try_parse_file(plate_file)
+            return
+        with ThreadPool(processes=self._threads) as pool:
+            for res in pool.imap_unordered(self._try_parse_file, files):
+                yield res
+
+    def _try_parse_file(self, plate_file):
+        try:
+            return plate_file, self._parse_file(plate_file)
+        except (ValueError, TypeError, AssertionError, FileNotFoundError) as e:
+            logger.error(
+              "Could not parse: {} -> {}".format(plate_file, str(e)))
+        return plate_file, None
 
     def _parse_file(self, plate_file):
         """
@@ -81,29 +151,35 @@ class PlateFilesParser:
         file = plate_file.filename
         if file is None:
             raise FileNotFoundError("Could not find file: {}".format(file))
-        matrix = self._alloc(load_matlab(file), file, featurename)
+        values, lengths = load_measurement(file, self._dtype)
+        matrix = self._alloc(values, lengths, file, featurename)
         return matrix
 
     @staticmethod
-    def _alloc(arr, file, f_name):
+    def _feature_name(f_name):
         f_name = str(f_name).lower()
         if f_name.endswith(".mat"):
             f_name = f_name.replace(".mat", "")
+        return f_name
+
+    @staticmethod
+    def _feature_group(f_name):
+        return PlateFilesParser._feature_name(f_name).split(".")[0]
+
+    def _alloc(self, values, lengths, file, f_name):
+        f_name = self._feature_name(f_name)
+        if len(lengths) == 0:
+            raise ValueError("Found no images in file: {}".format(file))
         try:
-            n_row = len(arr)
-            row_lens = [len(x) for x in arr]
-            max_n_col = max(row_lens)
-            mat = numpy.full(shape=(n_row, max_n_col),
-                             fill_value=numpy.Infinity,
-                             dtype="float64")
-            for i, _ in enumerate(arr):
-                try:
-                    row = arr[i]
-                    mat[i][:len(row)] = row.flatten()
-                except ValueError:
-                    mat[i][0] = numpy.Infinity
+            # the images as one flat array of cells, which is padded to a
+            # matrix of images x cells with a single scatter if needed
+            if self._ragged:
+                return FeatureMatrix(
+                  values, len(lengths), int(lengths.max()), file,
+                  lengths.tolist(), f_name, offsets(lengths))
+            mat = ragged_to_dense(values, lengths, numpy.Infinity)
             return FeatureMatrix(
-              mat, n_row, max_n_col, file, row_lens, f_name)
+              mat, len(lengths), mat.shape[1], file, lengths.tolist(), f_name)
         except AssertionError:
             raise AssertionError(
               "Could not alloc feature %s of %s", f_name, file)
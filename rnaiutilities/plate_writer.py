@@ -19,12 +19,19 @@
 # @email = 'simon.dirmeier@bsse.ethz.ch'
 
 
+import json
 import logging
 import re
-import yaml
 from pathlib import Path
 
+import numpy
+import pandas
+
+from rnaiutilities.globals import TSV, PARQUET, ELEMENTS, FEATURES, \
+    ROW_INDEX, MOMENTS, WELL_STATISTICS
 from rnaiutilities.library_plate_layout import LibraryPlateLayout
+from rnaiutilities.normalization.moments import FeatureMoments
+from rnaiutilities.normalization.well_statistics import WellStatistics
 from rnaiutilities.utility.check import check_feature_group
 from rnaiutilities.utility.files import data_filename, meta_filename
 
@@ -40,9 +47,14 @@ class PlateWriter:
     __NA__ = "NA"
     _meta_ = ["well", "gene", "sirna", "well_type", "image_idx", "object_idx"]
     _well_regex = re.compile("(\w)(\d+)")
+    # number of rows of a row group/record batch in binary formats
+    _row_group_size_ = 2 ** 16
+    # number of values of the features that are aggregated to wells at once
+    _well_batch_size_ = 2 ** 22
 
-    def __init__(self, layout_file):
+    def __init__(self, layout_file, fmt=TSV):
         self._layout = LibraryPlateLayout(layout_file)
+        self._format = fmt
 
     def write(self, pfs, feature_groups, mapping):
         logger.info(
@@ -51,6 +63,25 @@ class PlateWriter:
             self._write(pfs, k, v, mapping)
         return 0
 
+    def write_feature_group(self, pfs, feature_group, features, mapping):
+        """
+        Write the features of a single feature group of a plate, e.g. as soon
+        as the group has been parsed.
+
+        :param pfs: the plate file set of the features
+        :type pfs: PlateFileSet
+        :param feature_group: the name of the group, e.g. 'cells'
+        :type feature_group: str
+        :param features: the features of the group
+        :type features: list(FeatureMatrix)
+        :param mapping: the siRNA/gene mapping of the images of the plate
+        :type mapping: PlateSirnaGeneMapping
+        """
+
+        logger.info("Integrating {} of plate file set: {}".format(
+          feature_group, str(pfs.classifier)))
+        self._write(pfs, feature_group, features, mapping)
+
     def _write(self, pfs, feature_group, features, mapping):
         layout = self._get_layout(pfs)
         if layout is None and pfs.pathogen.lower() != "mock":
@@ -68,7 +99,7 @@ class PlateWriter:
     def _write_file(self, pfs, features, feature_group, mapping, layout):
         filename = pfs.outfile + "_" + feature_group
         try:
-            if not Path(data_filename(filename)).exists():
+            if not Path(data_filename(filename, self._format)).exists():
                 logger.info("Writing to: {}".format(filename))
                 self._dump(filename, features, mapping, layout)
                 logger.info("Success!")
@@ -82,57 +113,206 @@ class PlateWriter:
         check_feature_group(features)
         feature_names = [feat.featurename.lower() for feat in features]
         header = PlateWriter._meta_ + feature_names
-        dat_file = data_filename(filename)
+        dat_file = data_filename(filename, self._format)
+        nimg = features[0].n_images
+        assert nimg == len(mapping)
 
         meat_hash = {}
-        with open(dat_file, "w") as f:
-            f.write("\t".join(header) + "\n")
-            nimg = features[0].values.shape[0]
-            assert nimg == len(mapping)
-            self._dump_images(
-              nimg, layout, mapping, features, f, header, meat_hash)
-        self._write_meta(filename, meat_hash, feature_names)
+        # runs of consecutive rows of the same well/gene/sirna
+        index = []
+        if self._format == TSV:
+            with open(dat_file, "w", encoding="utf-8") as f:
+                head = "\t".join(header) + "\n"
+                f.write(head)
+                self._dump_images(
+                  nimg, layout, mapping, features, f, header, meat_hash,
+                  index, len(head.encode()))
+        else:
+            self._dump_columnar(
+              dat_file, nimg, layout, mapping, features, header, meat_hash,
+              index)
+        img, obj = self._cells(features, nimg)
+        moments = self._moments(features, img, obj)
+        wells = self._well_statistics(features, img, obj, mapping)
+        self._write_meta(
+          filename, meat_hash, feature_names, index, moments, wells)
 
         return 0
 
-    def _dump_images(self, nimg, layout, mapping, features, f, header, meat):
+    @staticmethod
+    def _image_meta(layout, well):
+        meta = [PlateWriter.__NA__] * 4
+        meta[0] = well
+        if layout is not None:
+            meta[1] = layout.gene(well)
+            meta[2] = layout.sirna(well)
+            meta[3] = layout.welltype(well)
+        return meta
+
+    def _dump_images(self, nimg, layout, mapping, features, f, header, meat,
+                     index, offset):
         meta = [PlateWriter.__NA__] * len(PlateWriter._meta_)
+        row = 0
         for iimg in range(nimg):
-            well = mapping[iimg]
-            meta[0] = well
-            if layout is not None:
-                meta[1] = layout.gene(well)
-                meta[2] = layout.sirna(well)
-                meta[3] = layout.welltype(well)
+            meta[:4] = self._image_meta(layout, mapping[iimg])
             meta[4] = iimg + 1
             meat[";".join(map(str, meta[:4]))] = 1
-            self._dump_cells(features, iimg, meta, f, header)
+            block = self._render_cells(features, iimg, meta, header)
+            f.write(block)
+            # rows and bytes of the image for seeking to the well later
+            nrow, nbyte = int(features[0].ncells[iimg]), len(block.encode())
+            self._add_to_index(
+              index, [str(m).lower() for m in meta[:3]],
+              [row, row + nrow, offset, offset + nbyte])
+            row, offset = row + nrow, offset + nbyte
+
+    @staticmethod
+    def _add_to_index(index, key, bounds):
+        # extend the last run if the image continues it, bounds are pairs of
+        # start and stop positions
+        if bounds[0] == bounds[1]:
+            return
+        if index and index[-1][:3] == key and index[-1][4] == bounds[0]:
+            for i in range(1, len(bounds), 2):
+                index[-1][3 + i] = bounds[i]
+        else:
+            index.append(key + bounds)
+
+    @staticmethod
+    def _cells(features, nimg):
+        # image and object index of every cell of the plate
+        ncells = numpy.asarray(features[0].ncells[:nimg], dtype="int64")
+        img = numpy.repeat(numpy.arange(nimg), ncells)
+        obj = numpy.arange(len(img)) - numpy.repeat(
+          numpy.cumsum(ncells) - ncells, ncells)
+        return img, obj
+
+    @staticmethod
+    def _moments(features, img, obj):
+        """
+        Compute the moments of every feature over all cells of the plate, in
+        the same blocks of rows in which a query streams the data file, such
+        that z-scores of selected rows do not need to read the entire file.
+        The moments are computed from the exact values, which can differ in
+        the last digits from the values that are parsed from tsv files, e.g.
+        for float32 features. Queries therefore use the stored moments for
+        all rows of a plate, whether filtered or not.
+
+        :return: returns the moments of the features
+        :rtype: FeatureMoments
+        """
+
+        moments = FeatureMoments(len(features))
+        size = FeatureMoments._block_size_
+        for i in range(0, len(img), size):
+            # float32 features are summed like the float64 values a query
+            # reads them as
+            moments.update(numpy.column_stack(
+              [feature.take(img[i:i + size], obj[i:i + size])
+               for feature in features]).astype("float64", copy=False))
+        return moments
+
+    @staticmethod
+    def _well_statistics(features, img, obj, mapping):
+        """
+        Compute the moments and medians of every feature in every well of
+        the plate in batches of features, such that queries estimate
+        B-scores, LOESS fits and z-scores of the entire plate when they only
+        read the rows of some wells.
+
+        :return: returns the statistics of the wells
+        :rtype: WellStatistics
+        """
+
+        # the wells of the cells as they are written to the data file
+        wells = numpy.array(
+          [str(mapping[i]).lower() for i in range(len(mapping))],
+          dtype=object)[img]
+        size = max(1, PlateWriter._well_batch_size_ // max(len(img), 1))
+        statistics = []
+        for i in range(0, len(features), size):
+            statistics.append(WellStatistics.from_values(numpy.column_stack(
+              [feature.take(img, obj) for feature in features[i:i + size]])
+              .astype("float64", copy=False), wells))
+        return WellStatistics.concat(statistics)
+
+    def _dump_columnar(self, dat_file, nimg, layout, mapping, features,
+                       header, meat, index):
+        img, obj = self._cells(features, nimg)
+        ncells = numpy.asarray(features[0].ncells[:nimg], dtype="int64")
+
+        image_meta = []
+        for iimg in range(nimg):
+            meta = self._image_meta(layout, mapping[iimg])
+            meat[";".join(map(str, meta))] = 1
+            image_meta.append([str(m).lower() for m in meta])
+        image_meta = numpy.array(image_meta, dtype=object).reshape(nimg, 4)
+        starts = numpy.cumsum(ncells) - ncells
+        for iimg in range(nimg):
+            self._add_to_index(
+              index, list(image_meta[iimg, :3]),
+              [int(starts[iimg]), int(starts[iimg] + ncells[iimg])])
+
+        # meta columns are stored as categoricals, features as floats of the
+        # parsed type
+        data = {}
+        for i, col in enumerate(PlateWriter._meta_[:4]):
+            data[col] = pandas.Categorical(image_meta[img, i])
+        data[PlateWriter._meta_[4]] = img + 1
+        data[PlateWriter._meta_[5]] = obj + 1
+        for col, feature in zip(header[len(PlateWriter._meta_):], features):
+            # cells that lie outside of the feature matrix are NA
+            data[col] = feature.take(img, obj)
+        data = pandas.DataFrame(data, columns=header)
+
+        # bounded row groups let readers skip the rows of other wells
+        if self._format == PARQUET:
+            data.to_parquet(dat_file, index=False,
+                            row_group_size=PlateWriter._row_group_size_)
+        else:
+            data.to_feather(dat_file, chunksize=PlateWriter._row_group_size_)
+
+    @staticmethod
+    def _render_cells(features, iimg, meta, header):
+        # render the cells of a single image as one block: every feature
+        # contributes one column of the 2D slice, cells beyond the size of a
+        # feature matrix are NA, and the block is written with one call
+        ncells = features[0].ncells[iimg]
+        if ncells == 0:
+            return ""
+        try:
+            block = numpy.empty(shape=(ncells, len(features)), dtype=object)
+            for p, feature in enumerate(features):
+                block[:, p] = PlateWriter._render_column(
+                  feature, iimg, ncells)
+            prefix = "\t".join(map(str, meta[:5])).lower() + "\t"
+            objs = numpy.arange(1, ncells + 1).astype(str).tolist()
+            lines = [prefix + o + "\t" + "\t".join(v)
+                     for o, v in zip(objs, block.tolist())]
+            return "\n".join(lines) + "\n"
+        except Exception:
+            na = "\t".join([PlateWriter.__NA__] * len(header)) + "\n"
+            return na * ncells
 
     @staticmethod
-    def _dump_cells(features, iimg, meta, f, header):
-        for cell in range(features[0].ncells[iimg]):
-            vals = [PlateWriter.__NA__] * len(features)
-            for p, _ in enumerate(features):
-                try:
-                    vals[p] = features[p].values[iimg, cell]
-                except IndexError:
-                    vals[p] = PlateWriter.__NA__
-            meta[5] = cell + 1
-            try:
-                f.write("\t".join(list(map(str, meta)) +
-                                  list(map(str, vals))).lower() + "\n")
-            except Exception:
-                f.write("\t".join([PlateWriter.__NA__] * len(header)) + "\n")
+    def _render_column(feature, iimg, ncells):
+        col = numpy.full(ncells, PlateWriter.__NA__.lower(), dtype=object)
+        row = feature.cells(iimg, ncells)
+        col[:len(row)] = row.astype(str)
+        return col
 
     @staticmethod
-    def _write_meta(filename, meat_hash, features):
-        h = {'elements': list(meat_hash.keys()),
-             'features': features}
+    def _write_meta(filename, meat_hash, features, index, moments, wells):
+        h = {ELEMENTS: list(meat_hash.keys()),
+             FEATURES: features,
+             ROW_INDEX: index,
+             MOMENTS: moments.to_dict(),
+             WELL_STATISTICS: wells.to_dict()}
 
         meat_file = meta_filename(filename)
         try:
             with open(meat_file, "w") as m:
-                yaml.dump(h, m, default_flow_style=False)
+                json.dump(h, m)
         except Exception as e:
             logger.error(
               "Some IO-error writing to meta file: {}".format(meat_file))
@@ -23,6 +23,7 @@ import sys
 import logging
 
 from rnaiutilities.db.dbms import DBMS
+from rnaiutilities.globals import GENE, SIRNA, WELL
 from rnaiutilities.query_result import QueryResult
 
 logger = logging.getLogger(__name__)
@@ -114,7 +115,11 @@ class Query:
                 gene=None,
                 sirna=None,
                 well=None,
-                featureclass=None):
+                featureclass=None,
+                seed=None,
+                regex=False,
+                cache=None,
+                cache_size=None):
         """
         Query a database of image-based RNAi screening features for cells/bacteria/nuclei.
         The query can use filters, so that only a subset is selected.
@@ -137,6 +142,15 @@ class Query:
         :param well: filters by gene, i.e.: 'a01'
         :param featureclass: filters by featureclass,
           e.g. 'nuclei'/'cells'/'bacteria'
+        :param seed: seed for sampling cells from wells such that samples are
+          reproducible, or None
+        :param regex: if True, the gene/sirna/well filters are regular
+          expressions that have to match entire values. Otherwise values have
+          to be equal to one of the filters
+        :param cache: a folder in which decoded plate data files are cached
+          for repeated queries, or None
+        :param cache_size: the maximum size of the cache in bytes. Least
+          recently used plates are deleted from the cache beyond this size
         :return: returns a lazy QueryResult
         :rtype: QueryResult
         """
@@ -151,14 +165,24 @@ class Query:
                              gene=gene,
                              sirna=sirna,
                              well=well,
-                             featureclass=self._featureclass(featureclass))
+                             featureclass=self._featureclass(featureclass),
+                             seed=seed,
+                             regex=regex,
+                             cache=cache,
+                             cache_size=cache_size)
 
-    def _compose(self, from_file, **kwargs):
+    def _compose(self, from_file, seed, regex, cache, cache_size, **kwargs):
+        db_kwargs = dict(kwargs)
+        if regex:
+            # the data base only matches exact values, so regular
+            # expressions are matched on the plate data only
+            db_kwargs.update({GENE: None, SIRNA: None, WELL: None})
         with DBMS(self._db) as d:
-            res = d.tableset(from_file, **kwargs)
-        return QueryResult(res, **kwargs)
+            res = d.tableset(from_file, **db_kwargs)
+        return QueryResult(res, seed=seed, regex=regex, cache=cache,
+                           cache_size=cache_size, **kwargs)
 
-    def insert(self, path):
+    def insert(self, path, workers=1):
         """
         Insert meta information of an platewise RNAi screen to a database.
         For insertion the path leading to the meta files has to be provided.
@@ -168,10 +192,12 @@ class Query:
 
         :param path: the folder to the meta files
         :type path: str
+        :param workers: number of processes that read the meta files
+        :type workers: int
         """
 
         with DBMS(self._db) as d:
-            d.insert(path)
+            d.insert(path, workers)
 
     def select(self,
                select,
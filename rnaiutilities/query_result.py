@@ -19,8 +19,12 @@
 # @email = 'simon.dirmeier@bsse.ethz.ch'
 
 
+import itertools
 import logging
+import multiprocessing as mp
 import os
+import re
+import zlib
 
 import enforce
 import numpy as np
@@ -28,12 +32,19 @@ import pandas
 
 from rnaiutilities.data_set import DataSet
 from rnaiutilities.globals import WELL, GENE, SIRNA, \
-    SAMPLE, ADDED_COLUMNS_FOR_PRINTING, RESPONSES
+    SAMPLE, ADDED_COLUMNS_FOR_PRINTING, RESPONSES, PLATE, REPLICATE, \
+    NORMALIZATION_LEVELS, ROW_INDEX, FEATURES, MOMENTS, WELL_STATISTICS
 from rnaiutilities.io.io import IO
+from rnaiutilities.io.plate_cache import PlateCache
+from rnaiutilities.normalization.moments import FeatureMoments
 from rnaiutilities.normalization.normalizer import Normalizer
+from rnaiutilities.normalization.well_statistics import WellStatistics
 from rnaiutilities.table_file_set import TableFileSet
+from rnaiutilities.utility.files import read_meta
 from rnaiutilities.utility.functional import filter_by_prefix, \
     inverse_filter_by_prefix
+from rnaiutilities.utility.memory import peak_memory, reset_peak_memory
+from rnaiutilities.utility.pool import bounded_imap
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -45,15 +56,30 @@ class QueryResult:
     """
 
     _filter_attributes_ = [GENE, SIRNA, WELL, SAMPLE]
-    _sar_ = ".*"
+    # maximum number of rows of a plate that are used for estimating
+    # B-score/LOESS parameters when only a selection of rows of a plate
+    # without stored well statistics is read
+    _reference_size_ = 2 ** 16
 
-    def __init__(self, tablefile_sets, **kwargs):
+    def __init__(self, tablefile_sets, seed=None, regex=False, cache=None,
+                 cache_size=None, **kwargs):
         self._tablefile_sets = tablefile_sets
+        # cache of decoded data files if a cache folder is given
+        self._cache = None
+        if cache is not None:
+            self._cache = PlateCache(cache) if cache_size is None \
+                else PlateCache(cache, cache_size)
+        # match filters as regular expressions instead of exact values
+        self._regex = regex
         # filters applied for querying
         self._filters = self._set_filter(**kwargs)
         self._shared_features = self._get_shared_features()
-        self._sample, self._filter_fn = 2 ** 30, lambda x: x
+        self._sample = None
+        self._seed = seed
         self._normalizer = Normalizer()
+        self._level = PLATE
+        # pooled feature statistics for every replicate or screen
+        self._statistics = {}
 
     def __repr__(self):
         return self.__str__()
@@ -65,11 +91,41 @@ class QueryResult:
         for tablefileset in self._tablefile_sets:
             yield self._compile(tablefileset)
 
-    def dump(self, sample, normalize, fh=None):
+    def dump(self, sample, normalize, fh=None, workers=1, level=PLATE,
+             chunk_size=None):
         """
         Print the result set of the database query to tsv or stdout. If a string
         is given as param *fh* prints to file, otherwise if None is given prints
-        to stdout.
+        to stdout. Files that do not end with 'tsv' are written as one
+        compressed table of an hdf5 file that can be queried on the meta
+        columns.
+
+        If *workers* is larger than one, plates are compiled in a process pool
+        and written in the same order as they would be sequentially. At most
+        two plates per worker are compiled ahead of the writer.
+
+        If *level* is 'replicate' or 'screen', z-scores are computed using
+        the feature statistics of all plates of a replicate or screen. The
+        statistics are accumulated in a first pass over the plates, such that
+        only single plates are held in memory.
+
+        If *chunk_size* is given, the data files of a plate are read, filtered,
+        normalized and written in aligned chunks of at most *chunk_size* rows,
+        such that memory is bounded by the chunk size and not by the size of
+        a plate. Plates are compiled sequentially and without cache in this
+        case.
+
+        If only a selection of the rows of a plate is in memory, i.e. for
+        filtered, sampled or chunked plates, z-scores are computed with the
+        exact statistics of the plate, which are stored in the meta files
+        when a plate is parsed or, for files of older versions, accumulated
+        in a chunked pass over its rows. B-score and LOESS parameters, and
+        z-scores that follow them, are estimated on the statistics of the
+        wells of the plate that are stored in the meta files, too, such that
+        rows are normalized the same way whether the plate is filtered or
+        not. For files of older versions they are estimated on a bounded
+        sample of reference rows that only depends on the plate, such that
+        queries without seed are reproducible, too.
 
         :param sample: number of samples to draw from every well or None
         :param sample: int or None
@@ -78,16 +134,47 @@ class QueryResult:
         :type normalize: list(str)
         :param fh: name of the file or None
         :type fh: str
+        :param workers: number of processes used for compiling plates
+        :type workers: int
+        :param level: the set of plates over which z-scores are computed,
+         i.e. 'plate', 'replicate' or 'screen'
+        :type level: str
+        :param chunk_size: number of rows that are read and written at once
+         or None if plates are read entirely
+        :type chunk_size: int
         """
 
         self._set_normalization(normalize, RESPONSES)
         self._set_sample_size(sample)
+        self._set_level(level, workers)
         with IO(fh) as io:
-            for data in self:
+            for data in self._compiled(workers, chunk_size):
                 if data is not None:
                     io.dump(data)
         logger.info("Successfully wrote table files!")
 
+    def _compiled(self, workers, chunk_size=None):
+        if chunk_size is not None:
+            return self._compile_chunked(workers, chunk_size)
+        if workers is None or workers <= 1:
+            return iter(self)
+        return self._compile_parallel(workers)
+
+    def _compile_chunked(self, workers, chunk_size):
+        if workers is not None and workers > 1:
+            logger.warning("Compiling chunks of plates sequentially.")
+        if self._cache is not None:
+            logger.warning("Reading chunks of plates without cache.")
+        for tablefileset in self._tablefile_sets:
+            yield from self._compile_chunks(tablefileset, chunk_size)
+
+    def _compile_parallel(self, workers):
+        # keep a bounded queue of plates that are compiled in the pool and
+        # hand them out in the order of the table file sets
+        logger.info("Compiling plates with {} processes.".format(workers))
+        return bounded_imap(_compile_in_worker, self._tablefile_sets, workers,
+                            _init_compose_worker, (self,))
+
     def _set_normalization(self, normalize, skip_features):
         """
         Set the used normalisations.
@@ -97,11 +184,90 @@ class QueryResult:
 
         self._normalizer.set_normalization(normalize, skip_features)
 
+    def _set_level(self, level, workers):
+        if level not in NORMALIZATION_LEVELS:
+            raise ValueError(
+              "Please select only levels: {}"
+              .format("/".join(NORMALIZATION_LEVELS)))
+        self._level = level
+        self._statistics = {}
+        if level == PLATE or not self._normalizer.uses_zscore():
+            return
+        logger.info("Accumulating feature statistics per {}.".format(level))
+        for key, stats in self._accumulated(workers):
+            if stats is None:
+                continue
+            if key in self._statistics:
+                self._statistics[key].merge(stats)
+            else:
+                self._statistics[key] = stats
+
+    def _accumulated(self, workers):
+        if workers is None or workers <= 1:
+            return map(self._accumulate, self._tablefile_sets)
+        return self._accumulate_parallel(workers)
+
+    def _accumulate_parallel(self, workers):
+        pool = mp.Pool(processes=workers,
+                       initializer=_init_compose_worker, initargs=(self,))
+        try:
+            for res in pool.imap(_accumulate_in_worker, self._tablefile_sets):
+                yield res
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def _accumulate(self, tablefileset):
+        """
+        Compute the feature statistics of a single plate.
+
+        :return: returns the key of the replicate or screen of the plate and
+         its statistics or None if the plate could not be read
+        """
+
+        key = self._statistics_key(tablefileset)
+        try:
+            # z-scores of raw values can use the moments of the data files
+            if self._normalizer.zscore_first():
+                moments = self._stored_moments(tablefileset)
+                if moments is not None:
+                    return key, moments
+            data = self._read(tablefileset)
+            return key, self._normalizer.accumulate(data, None)
+        except Exception as e:
+            logger.error("Error occured for tablefileset {}: {}"
+                         .format(tablefileset.classifier, e))
+        return key, None
+
+    def _statistics_key(self, tablefileset):
+        key = (tablefileset.study, tablefileset.pathogen,
+               tablefileset.library, tablefileset.design)
+        if self._level == REPLICATE:
+            key += (tablefileset.replicate,)
+        return key
+
     def _set_sample_size(self, sample):
-        self._sample = sample if sample is not None else 2 ** 30
-        # lambda function for sampling
-        self._filter_fn = lambda x: x.loc[np.random.choice(
-          x.index, self._sample, False), :] if len(x) >= self._sample else x
+        self._sample = sample
+
+    def _random_state(self, tablefileset):
+        # every plate gets its own stream, such that samples do not depend
+        # on the order in which plates are compiled
+        if self._seed is None:
+            return np.random
+        return np.random.RandomState(
+          [self._seed, self._plate_key(tablefileset)])
+
+    def _reference_state(self, tablefileset):
+        # reference rows for normalisation only depend on the plate, such
+        # that a plate is normalized the same way with or without seed
+        return np.random.RandomState(self._plate_key(tablefileset))
+
+    @staticmethod
+    def _plate_key(tablefileset):
+        plate = "/".join(map(str, [
+            tablefileset.study, tablefileset.pathogen, tablefileset.library,
+            tablefileset.design, tablefileset.replicate, tablefileset.plate]))
+        return zlib.crc32(plate.encode("utf-8"))
 
     def _compile(self, tablefileset):
         """
@@ -111,12 +277,27 @@ class QueryResult:
         try:
             # test if the data files can be found
             if all(os.path.isfile(f) for f in tablefileset.filenames):
+                reset_peak_memory()
+                # decide which rows are filtered/sampled before reading
+                wells = self._well_statistics(tablefileset)
+                rows, selected, reference = self._select_rows(
+                  tablefileset, self._random_state(tablefileset),
+                  wells is None)
+                # use the statistics of the replicate/screen or of the
+                # entire plate if only selected rows are read
+                self._normalizer.set_statistics(
+                  self._zscore_statistics(tablefileset, rows is not None))
+                params = None if wells is None else \
+                    self._normalizer.fit_wells(wells, self._shared_features)
                 # read the data files, i.e. cells/nuclei/perinuclei
-                data = self._read(tablefileset)
+                meta, values = self._read_block(tablefileset, rows)
                 # compile everything together
-                data = self._process(data)
+                meta, values = self._process(
+                  meta, values, selected, reference, params)
+                data = self._data_set(meta, values, tablefileset)
                 # append study/pathogen/library/...
                 data = self._insert_columns(data, tablefileset)
+                self._log_peak_memory(tablefileset)
                 return data
             else:
                 raise ValueError("Could not find files: {}".format(
@@ -126,37 +307,400 @@ class QueryResult:
                          .format(tablefileset.classifier, e))
         return None
 
+    def _compile_chunks(self, tablefileset, chunk_size):
+        """
+        Converts a table file set to pandas dataframes of at most
+        *chunk_size* rows.
+        """
+
+        try:
+            if not all(os.path.isfile(f) for f in tablefileset.filenames):
+                raise ValueError("Could not find files: {}".format(
+                  ", ".join(tablefileset.filenames)))
+            reset_peak_memory()
+            wells = self._well_statistics(tablefileset)
+            rows, reference = self._chunk_rows(
+              tablefileset, *self._select_rows(
+                tablefileset, self._random_state(tablefileset),
+                wells is None), wells is None)
+            # estimate the normalisation on the well statistics or the
+            # reference rows first
+            params = None if self._normalizer.normalizes() else []
+            if params is None:
+                self._normalizer.set_statistics(
+                  self._zscore_statistics(tablefileset, True))
+                if wells is not None:
+                    params = self._normalizer.fit_wells(
+                      wells, self._shared_features)
+                elif self._needs_reference():
+                    params = self._normalizer.fit(
+                      self._read(tablefileset, reference))
+            for data in self._read_chunks(tablefileset, rows, chunk_size):
+                # z-scores alone only need the statistics of the plate
+                if params is None:
+                    params = self._normalizer.fit(data)
+                data = self._normalizer.transform(data, params)
+                yield self._insert_columns(data, tablefileset)
+            self._log_peak_memory(tablefileset)
+        except Exception as e:
+            logger.error("Error occured for tablefileset {}: {}"
+                         .format(tablefileset.classifier, e))
+
+    def _chunk_rows(self, tablefileset, rows, selected, reference,
+                    sample_reference=True):
+        """
+        Convert the selection of `_select_rows` into the rows that are
+        returned and the rows normalisation parameters are estimated on.
+
+        :param sample_reference: whether normalisation parameters are
+         estimated on reference rows of the plate
+        :type sample_reference: bool
+        :return: returns the sorted indexes of the returned rows and of the
+         reference rows, each None if all rows are needed
+        """
+
+        if selected is not None:
+            selected = np.flatnonzero(selected) if rows is None \
+                else rows[selected]
+            return selected, rows[reference] if reference is not None \
+                else None
+        if rows is not None or not sample_reference or \
+                not self._needs_reference():
+            return rows, None
+        # all rows are returned, but only a bounded sample is held in memory
+        # for estimating the normalisation
+        _, _, nrow = self._filtered_rows(tablefileset)
+        if nrow <= QueryResult._reference_size_:
+            return None, None
+        return None, self._reference_rows(tablefileset, nrow)
+
+    def _select_rows(self, tablefileset, random_state, sample_reference=True):
+        """
+        Apply the well/gene/sirna filters and the per-well sample size to the
+        meta columns of a plate, such that only the rows that are returned
+        need to be read. Since B-scores and LOESS fits need the wells of the
+        entire plate, a bounded uniform sample of reference rows of the plate
+        is read for them, too, unless the statistics of the wells are stored.
+
+        :param sample_reference: whether normalisation parameters are
+         estimated on reference rows of the plate
+        :type sample_reference: bool
+        :return: returns the sorted indexes of the rows to read, a mask of
+         the rows that are returned and a mask of the reference rows for
+         normalisation. Each is None if all rows are needed
+        """
+
+        if not self._filtered() and self._sample is None:
+            return None, None, None
+        rows, groups, nrow = self._filtered_rows(tablefileset)
+        if len(rows) == 0:
+            raise ValueError("Data is zero after filtering")
+        if self._sample is not None:
+            logger.info("\tsampling {} cells/well.".format(str(self._sample)))
+            rows = rows[self._sample_rows(groups, self._sample, random_state)]
+            if len(rows) == 0:
+                raise ValueError("Data is zero after sampling.")
+        if not sample_reference or not self._needs_reference():
+            return rows, None, None
+        if nrow <= QueryResult._reference_size_:
+            # small plates are read entirely
+            return None, np.isin(np.arange(nrow), rows), None
+        reference = self._reference_rows(tablefileset, nrow)
+        read = np.union1d(rows, reference)
+        return read, np.isin(read, rows), np.isin(read, reference)
+
+    def _needs_reference(self):
+        # z-scores alone are computed from the statistics of the entire
+        # plate, every other method is estimated on rows of the plate
+        return self._normalizer.normalizes() and \
+            not self._normalizer.zscore_only()
+
+    def _reference_rows(self, tablefileset, nrow):
+        return np.sort(self._reference_state(tablefileset).choice(
+          nrow, QueryResult._reference_size_, replace=False))
+
+    def _zscore_statistics(self, tablefileset, streamed):
+        """
+        Get the statistics that the features of a plate are z-scored with,
+        i.e. the pooled statistics of its replicate or screen, or the moments
+        of all rows of the plate. The moments are taken from the meta files
+        if they have been stored there when the plate was parsed, and are
+        otherwise computed in a pass over the plate if only some rows of it
+        are in memory.
+
+        :param streamed: whether only some rows of the plate are in memory
+        :type streamed: bool
+        :return: returns the moments of the shared features or None if the
+         statistics are computed from the rows in memory
+        :rtype: FeatureMoments
+        """
+
+        if self._level != PLATE:
+            return self._statistics.get(self._statistics_key(tablefileset))
+        if not self._normalizer.zscore_first():
+            return None
+        moments = self._stored_moments(tablefileset)
+        if moments is None and streamed:
+            moments = self._plate_moments(tablefileset)
+        return moments
+
+    def _stored_moments(self, tablefileset):
+        """
+        Collect the moments of the shared features from the meta files of a
+        plate.
+
+        :return: returns the moments of the shared features or None if a
+         meta file has been written by an older version
+        :rtype: FeatureMoments
+        """
+
+        position = {c: i for i, c in enumerate(self._shared_features)}
+        found = np.zeros(len(position), dtype=bool)
+        moments = {k: np.zeros(len(position))
+                   for k in ["count", "mean", "m2"]}
+        nrow = 0
+        for meta_file in tablefileset.meta_filenames:
+            try:
+                meta = read_meta(meta_file)
+            except Exception:
+                return None
+            if not meta.get(MOMENTS) or not meta.get(ROW_INDEX):
+                return None
+            nrow = max(run[4] for run in meta[ROW_INDEX])
+            for i, feature in enumerate(meta[FEATURES]):
+                if feature in position:
+                    for k, v in moments.items():
+                        v[position[feature]] = meta[MOMENTS][k][i]
+                    found[position[feature]] = True
+        # features that are added for printing are zero in every row
+        moments["count"][~found] = nrow
+        return FeatureMoments.from_dict(moments)
+
+    def _well_statistics(self, tablefileset):
+        """
+        Collect the statistics of the wells of the shared features from the
+        meta files of a plate if B-scores or LOESS fits are estimated.
+
+        :return: returns the statistics of the wells or None if they are not
+         needed or a meta file has been written by an older version
+        :rtype: WellStatistics
+        """
+
+        if not self._needs_reference():
+            return None
+        index = self._row_index(tablefileset.meta_filenames[0])
+        if index is None:
+            return None
+        position = {c: i for i, c in enumerate(self._shared_features)}
+        wells = pandas.unique(index[WELL].values)
+        statistics = {k: np.zeros((len(wells), len(position)))
+                      for k in ["count", "mean", "m2", "median"]}
+        # features that are added for printing are zero in every row
+        statistics["count"][:] = (index["stop"] - index["start"]) \
+            .groupby(index[WELL].values).sum().reindex(wells).values[:, None]
+        for meta_file in tablefileset.meta_filenames:
+            try:
+                meta = read_meta(meta_file)
+            except Exception:
+                return None
+            stored = meta.get(WELL_STATISTICS)
+            if not stored:
+                return None
+            rows = pandas.Index(stored["wells"]).get_indexer(wells)
+            if (rows < 0).any():
+                return None
+            cols = np.array([i for i, f in enumerate(meta[FEATURES])
+                             if f in position], dtype="int64")
+            shared = [position[meta[FEATURES][i]] for i in cols]
+            for k, v in statistics.items():
+                v[:, shared] = np.asarray(stored[k], dtype="float64")[
+                  np.ix_(rows, cols)]
+        return WellStatistics(wells, **statistics)
+
+    def _plate_moments(self, tablefileset):
+        # a pass over the shared features of the plate in chunks that gives
+        # the same moments as all rows of the plate in memory
+        shared = set(self._shared_features)
+        moments = FeatureMoments(len(self._shared_features))
+        for _, values in self._read_blocks(
+              tablefileset, None, FeatureMoments._block_size_,
+              lambda x: x in shared):
+            moments.update(values)
+        return moments
+
+    def _filtered_rows(self, tablefileset):
+        """
+        Find the rows of a plate that match the filters, using the row index
+        of the meta file if available or the meta columns of the data file
+        otherwise.
+
+        :return: returns the indexes of the matching rows, their well/gene/
+         sirna group for sampling and the number of rows of the plate
+        """
+
+        index = self._row_index(tablefileset.meta_filenames[0])
+        if index is None:
+            meta = self._read_table(
+              tablefileset.filenames[0], lambda x: x in [WELL, GENE, SIRNA])
+            rows = np.flatnonzero(self._filter_rows(meta))
+            groups = None
+            if self._sample is not None:
+                groups = meta.iloc[rows].groupby(
+                  [WELL, GENE, SIRNA], sort=False, observed=True) \
+                    .ngroup().values
+            return rows, groups, len(meta)
+        runs = index[self._filter_rows(index)]
+        lengths = (runs["stop"] - runs["start"]).values
+        rows = np.repeat(runs["stop"].values - lengths.cumsum(), lengths) + \
+            np.arange(lengths.sum())
+        groups = np.repeat(runs.groupby(
+          [WELL, GENE, SIRNA], sort=False).ngroup().values, lengths)
+        return rows, groups, int(index["stop"].max())
+
+    @staticmethod
+    def _row_index(meta_file):
+        # runs of rows of the wells of a data file, files written by older
+        # versions have no index
+        try:
+            index = read_meta(meta_file).get(ROW_INDEX)
+        except Exception:
+            index = None
+        if not index:
+            return None
+        columns = [WELL, GENE, SIRNA, "start", "stop", "offset", "end"]
+        return pandas.DataFrame(index, columns=columns[:len(index[0])])
+
+    @staticmethod
+    def _runs(meta_file, rows):
+        # runs of a tsv file with their byte offsets that contain rows
+        if rows is None:
+            return None
+        index = QueryResult._row_index(meta_file)
+        if index is None or "offset" not in index:
+            return None
+        lo = np.searchsorted(rows, index["start"].values)
+        hi = np.searchsorted(rows, index["stop"].values)
+        return index.loc[hi > lo, ["start", "stop", "offset", "end"]] \
+            .values.tolist()
+
     @enforce.runtime_validation
-    def _read(self, tablefileset: TableFileSet):
+    def _read(self, tablefileset: TableFileSet, rows=None):
         """
         Read the data files from a plate and concatenate the single tables.
         Since the dimensions of the tables should be the same, the concatenation
         should work. If the dimensions do not fit (i.e. the mapping did not
-        work), `None` is returned.
+        work), an error is raised.
 
         :param tablefileset: the object to be parsed
         :type tablefileset: TableFileSet
-        :return: returns the merged data as DataSet or None if the concat did
-         not work
+        :param rows: sorted indexes of the rows to read or None for all rows
+        :type rows: numpy.ndarray
+        :return: returns the merged data as DataSet
         :rtype: DataSet
         """
 
-        # read the X files to memory
-        tables = [pandas.read_csv(f, sep="\t", header=0)
-                  for f in tablefileset.filenames]
+        return self._data_set(
+          *self._read_block(tablefileset, rows), tablefileset)
+
+    def _read_block(self, tablefileset, rows=None):
+        # read the X files to memory, but only the columns we need later
+        usecols = self._needed_columns(tablefileset)
+        tables = [self._read_table(f, usecols, rows, m)
+                  for f, m in zip(tablefileset.filenames,
+                                  tablefileset.meta_filenames)]
+        return self._merge_tables(tables, tablefileset)
+
+    def _read_chunks(self, tablefileset, rows, chunk_size):
+        """
+        Read the data files from a plate in aligned chunks of rows and
+        concatenate the single tables of every chunk.
+
+        :return: returns a generator of the merged chunks as DataSets
+        :rtype: generator
+        """
+
+        for meta, values in self._read_blocks(tablefileset, rows, chunk_size):
+            yield self._data_set(meta, values, tablefileset)
+
+    def _read_blocks(self, tablefileset, rows, chunk_size, usecols=None):
+        # the meta columns and feature blocks of aligned chunks of rows
+        if usecols is None:
+            usecols = self._needed_columns(tablefileset)
+        readers = [IO.iter_table(f, usecols, rows, self._runs(m, rows),
+                                 chunk_size)
+                   for f, m in zip(tablefileset.filenames,
+                                   tablefileset.meta_filenames)]
+        for tables in itertools.zip_longest(*readers):
+            # one of the files has fewer rows than the others
+            if any(t is None for t in tables):
+                raise ValueError(
+                  "TableFileSet's {} data files do not have "
+                  "matching dimensions.".format(tablefileset.classifier))
+            yield self._merge_tables(list(tables), tablefileset)
+
+    def _merge_tables(self, tables, tablefileset):
+        """
+        Merge the tables of the feature classes of a plate column-wise. The
+        block of the features that every table file set has is allocated once
+        and filled column by column from the single tables, instead of
+        concatenating, subsetting and reindexing copies of the plate. The
+        list of tables is emptied.
+        Features that are desired for printing but that a plate does not have
+        are set to zero.
+
+        :return: returns the meta columns of the plate, like gene/well/etc.,
+         and a column-major float64 array of rows x shared features
+        :rtype: tuple(pandas.DataFrame, numpy.ndarray)
+        """
+
         # check if the dimensions of the tables are the same
         self._check_table_dimensions(tables, tablefileset)
-        # iterate over the tables and drop the redundant meta information
-        tables = self._drop_meta_columns(tables, tablefileset)
-        # merge the three tables together column-wise
-        data_merged = pandas.concat(tables, axis=1)
+        meta = tables[0][self._meta_columns(tables, tablefileset)]
+        position = {c: i for i, c in enumerate(self._shared_features)}
+        values = np.zeros((len(meta), len(position)), order="F")
+        found = np.zeros(len(position), dtype=bool)
+        # release every table as soon as it has been copied
+        while tables:
+            table = tables.pop(0)
+            for col in filter_by_prefix(
+                  table.columns, tablefileset.feature_classes):
+                if col in position:
+                    values[:, position[col]] = table[col].values
+                    found[position[col]] = True
+        # add features that are explicitely desired
+        # but not found in every screen :(
+        for feature_class in tablefileset.feature_classes:
+            for col in ADDED_COLUMNS_FOR_PRINTING.get(feature_class, []):
+                add_col = feature_class + "." + col
+                if add_col in position:
+                    found[position[add_col]] = True
+        if not found.all():
+            raise ValueError(
+              "Data does not have the correct number of features. Skipping.")
+        return meta, values
 
-        return DataSet(data_merged,
+    def _data_set(self, meta, values, tablefileset):
+        # wrap the feature block into a frame without copying it
+        features = pandas.DataFrame(
+          values, index=meta.index, columns=self._shared_features, copy=False)
+        return DataSet(pandas.concat([meta, features], axis=1, copy=False),
                        tablefileset.feature_classes,
-                       tablefileset.features,
+                       list(self._shared_features),
                        tablefileset.classifier,
                        RESPONSES)
 
+    def _read_table(self, filename, usecols, rows=None, meta_file=None):
+        if self._cache is not None:
+            return self._cache.read_table(filename, usecols, rows)
+        runs = self._runs(meta_file, rows) if meta_file is not None else None
+        return IO.read_table(filename, usecols, rows, runs)
+
+    def _needed_columns(self, tablefileset):
+        # meta columns and the features every table file set has
+        shared = set(self._shared_features)
+        prefixes = tuple(tablefileset.feature_classes)
+        return lambda x: x in shared or not x.startswith(prefixes)
+
     @staticmethod
     def _check_table_dimensions(tables, tfs):
         for i in range(len(tables) - 1):
@@ -167,124 +711,128 @@ class QueryResult:
                       "matching dimensions.".format(tfs.classifier))
 
     @staticmethod
-    def _drop_meta_columns(tables, tablefileset):
+    def _meta_columns(tables, tablefileset):
         # get meta column names
         meta_cols = inverse_filter_by_prefix(
           tables[0].columns, tablefileset.feature_classes)
-        # iterate over the plate meta columns and drop them from the tables
+        # iterate over the plate meta columns and check they are the same
         for i in range(1, len(tables)):
             meta_cols_curr = inverse_filter_by_prefix(
               tables[i], tablefileset.feature_classes)
             if meta_cols != meta_cols_curr:
                 raise ValueError(
                   "Meta column names are not equal: {}".format(tablefileset))
+        return meta_cols
 
-            feat_col_names = filter_by_prefix(
-              tables[i], tablefileset.feature_classes)
-            tables[i] = tables[i][feat_col_names]
-
-        return tables
-
-    @enforce.runtime_validation
-    def _process(self, data: DataSet):
+    def _process(self, meta, values, selected=None, reference=None,
+                 params=None):
         """
-        Process a plate data set file. The following preprocessing
+        Process the block of features of a plate. The following preprocessing
          steps are done:
 
-        * drop columns that are not in the shared feature set, i.e., keep only
-          columns that every TableFileSet has
-        * normalize the features using the set normalisation parameters
-        * filter the data by the defined criteria (i.e. genes/sirna)
-        * sample the cells from every well
+        * normalize the features in place using the set normalisation
+          parameters
+        * keep the rows that have been filtered and sampled by
+          `_select_rows`
+
+        :param meta: the meta columns of the plate
+        :type meta: pandas.DataFrame
+        :param values: a column-major array of rows x shared features
+        :type values: numpy.ndarray
+        :param selected: a mask of the rows that are returned or None
+        :type selected: numpy.ndarray
+        :param reference: a mask of the rows that are used for estimating
+         normalisation statistics or None
+        :type reference: numpy.ndarray
+        :param params: the normalisation parameters that have been estimated
+         on the statistics of the wells of the plate or None
+        :type params: list
+        :return: returns the preprocessed meta columns and features
+        :rtype: tuple(pandas.DataFrame, numpy.ndarray)
+        """
+
+        values = self._normalizer.normalize_values(
+          values, self._shared_features, meta[WELL].values, reference,
+          params)
+        if selected is not None:
+            meta = meta[selected].reset_index(drop=True)
+            # select columns of the transpose to keep the block column-major
+            values = values.T[:, selected].T
+        return meta, values
 
-        :param data: a plate data set
-        :type data: DataSet
-        :return: returns the preprocessed data set or None
-        :rtype: DataSet
+    @staticmethod
+    def _log_peak_memory(tablefileset):
+        logger.info("\tpeak memory of plate {}: {:.1f} MB.".format(
+          tablefileset.classifier, peak_memory() / 2 ** 20))
+
+    def _filtered(self):
+        return any(self.__getattribute__("_" + k) is not None
+                   for k in [WELL, GENE, SIRNA])
+
+    def _filter_rows(self, meta):
+        keep = np.ones(len(meta), dtype=bool)
+        for k in [WELL, GENE, SIRNA]:
+            values = self.__getattribute__("_" + k)
+            # attributes without filter match all rows
+            if values is None:
+                continue
+            logger.info("\tfiltering data on {} '{}'."
+                        .format(k, ",".join(values)))
+            keep &= self._matches(meta[k], values)
+        return keep
+
+    def _matches(self, column, values):
         """
+        Match the distinct values of a column against the filter values and
+        map the result to the rows using the categorical codes of the column.
 
-        # only take subset of columns that every tablefileset has
-        # otherwise we don't get a nice tabular dataset in the end
-        data = self._set_correct_columns(data)
-        data = self._normalizer.normalize_plate(data)
-        # filter by well/sirna/gene
-        data = self._filter_data(data)
-        # sample from each well 'sample' number if times
-        data = self._sample_data(data)
+        :return: returns a mask of the rows that match any of the values
+        """
 
-        return data
+        if isinstance(column.dtype, pandas.CategoricalDtype):
+            codes, categories = column.cat.codes.values, column.cat.categories
+        else:
+            codes, categories = pandas.factorize(column)
+        if self._regex:
+            reg = re.compile("|".join("(?:{})".format(v) for v in values))
+            hits = np.array(
+              [reg.fullmatch(str(c)) is not None for c in categories],
+              dtype=bool)
+        else:
+            hits = np.asarray(pandas.Index(categories).isin(values))
+        # the code -1 of missing values indexes the appended False
+        return np.append(hits, False)[codes]
 
-    def _set_correct_columns(self, data):
-        # Subset the dataframe for columns that are shared
-        # in all tablefile sets.
-
-        feature_classes = data.feature_classes
-        # get the columns in data that are feature columns
-        feat_cols = set(filter_by_prefix(data.data.columns, feature_classes))
-        # get the columns that are meta columns, such as gene/well/etc.
-        meta_cols = inverse_filter_by_prefix(data.data.columns, feature_classes)
-        # make sure to only take columns that are in the
-        feat_cols = list(feat_cols & set(self._shared_features))
-        data.data = data.data[meta_cols + feat_cols]
-        # add features that are explicitely desired
-        # but not found in every screen :(
-        for feature_class in feature_classes:
-            if feature_class in ADDED_COLUMNS_FOR_PRINTING:
-                for col in ADDED_COLUMNS_FOR_PRINTING[feature_class]:
-                    add_col = feature_class + "." + col
-                    if add_col not in data.data:
-                        # add the new column
-                        data.data.insert(len(data.data.columns), add_col, 0)
-                        # add the column to the new feature set for later check
-                        feat_cols.append(add_col)
-        # sort columns
-        # (this should be a sufficient condition for optimal overlap)
-        feat_cols = sorted(feat_cols)
-        data.data = data.data.reindex(
-          meta_cols + feat_cols, axis=1, copy=False)
-        data.feature_columns = feat_cols
-
-        if len(data.feature_columns) != len(self._shared_features):
-            raise ValueError(
-              "Data does not have the correct number of features. Skipping.")
-        if data.data is None:
-            raise ValueError("Data is none after setting columns.")
-        return data
+    @staticmethod
+    def _sample_rows(groups, size, random_state):
+        """
+        Sample at most *size* rows without replacement from every group at
+        once by ranking a random key within the groups.
 
-    def _filter_data(self, data):
-        well = self.__getattribute__("_" + WELL)
-        gene = self.__getattribute__("_" + GENE)
-        sirna = self.__getattribute__("_" + SIRNA)
-        logger.info("\tfiltering data on well '{}', gene '{}' and sirna '{}'."
-                    .format(well, gene, sirna))
-        data.data = data.data[
-            data.data.well.str.contains(well) &
-            data.data.gene.str.contains(gene) &
-            data.data.sirna.str.contains(sirna)]
-        if len(data.data) == 0:
-            raise ValueError("Data is zero after filtering")
-        return data
+        :param groups: the group index of every row, -1 for rows that are not
+         in any group
+        :return: returns the sorted indexes of the sampled rows
+        """
 
-    def _sample_data(self, data):
-        if self.__getattribute__("_" + SAMPLE) != QueryResult._sar_:
-            logger.info("\tsampling {} cells/well.".format(str(self._sample)))
-            data.data = data.data.groupby([WELL, GENE, SIRNA]).apply(
-              self._filter_fn)
-            if len(data.data) == 0:
-                raise ValueError("Data is zero after sampling.")
-        return data
+        order = np.lexsort((random_state.random_sample(len(groups)), groups))
+        sorted_groups = groups[order]
+        starts = np.flatnonzero(
+          np.r_[True, sorted_groups[1:] != sorted_groups[:-1]])
+        counts = np.diff(np.r_[starts, len(groups)])
+        ranks = np.arange(len(groups)) - np.repeat(starts, counts)
+        rows = order[(ranks < size) & (sorted_groups >= 0)]
+        return np.sort(rows)
 
     def _set_filter(self, **kwargs):
         fls = []
+        for k in [WELL, GENE, SIRNA]:
+            self.__setattr__("_" + k, None)
         for k, v in kwargs.items():
             if k in QueryResult._filter_attributes_:
-                if v is not None:
-                    reg = "^" + "$|^".join(v.split(",")) + "$"
-                    # user provided gene/sirna/well regex to match
-                    self.__setattr__("_" + k, reg)
-                else:
-                    # if user didnt provide anything match all
-                    self.__setattr__("_" + k, QueryResult._sar_)
+                # user provided comma-separated gene/sirna/well values to
+                # match, if user didnt provide anything match all
+                self.__setattr__("_" + k, v.split(",") if v is not None
+                                 else None)
                 fls.append(v)
         return fls
 
@@ -313,3 +861,22 @@ class QueryResult:
         data.data.insert(0, "pathogen", table.pathogen)
         data.data.insert(0, "study", table.study)
         return data
+
+
+# query result that is used by the processes of a pool in `QueryResult.dump`
+_worker_result = None
+
+
+def _init_compose_worker(query_result):
+    global _worker_result
+    _worker_result = query_result
+    # forked processes would otherwise share the state of the parent's RNG
+    np.random.seed()
+
+
+def _compile_in_worker(tablefileset):
+    return _worker_result._compile(tablefileset)
+
+
+def _accumulate_in_worker(tablefileset):
+    return _worker_result._accumulate(tablefileset)
@@ -22,7 +22,7 @@
 import logging
 from pathlib import Path
 
-from rnaiutilities.globals import USABLE_FEATURES
+from rnaiutilities.globals import USABLE_FEATURES, TSV
 from rnaiutilities.plate.plate_file_sets import PlateFileSets
 from rnaiutilities.utility.files import usable_feature_files
 
@@ -35,7 +35,7 @@ class ParseStatistics:
     Class for checking if all files are parsed correctly.
     """
 
-    def __init__(self, plate_list, plate_folder, output_path):
+    def __init__(self, plate_list, plate_folder, output_path, fmt=TSV):
         """
         Constructor
 
@@ -45,11 +45,14 @@ class ParseStatistics:
         :type plate_folder: str
         :param output_path: the folder where all parsed files are put
         :type output_path: str
+        :param fmt: the format the data files have been written in
+        :type fmt: str
         """
 
         self._plate_list = plate_list
         self._plate_folder = plate_folder
         self._output_path = output_path
+        self._format = fmt
 
     def statistics(self):
         """
@@ -64,10 +67,10 @@ class ParseStatistics:
             else:
                 self._statistics(platefilesets, plate)
 
-    @staticmethod
-    def _statistics(platefilesets, plate):
+    def _statistics(self, platefilesets, plate):
         for platefileset in platefilesets:
-            uff = usable_feature_files(platefileset, USABLE_FEATURES)
+            uff = usable_feature_files(
+              platefileset, USABLE_FEATURES, self._format)
             cnt_all_files = len(uff)
             cnt_avail_files = sum([Path(x).exists() for x in uff])
             if cnt_all_files != cnt_avail_files:
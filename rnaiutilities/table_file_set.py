@@ -19,13 +19,17 @@
 # @email = 'simon.dirmeier@bsse.ethz.ch'
 
 from rnaiutilities.utility.array import unique
+from rnaiutilities.utility.files import find_data_filename, meta_filename
 
 
 class TableFileSet:
     def __init__(self, key, query_result, features, **kwargs):
         self._table_file_set_classifier = key
         f = [x[-1].replace("_meta.tsv", "") for x in query_result]
-        self.file_names = unique([el + "_data.tsv" for el in f])
+        files = unique([(find_data_filename(el), meta_filename(el))
+                        for el in f])
+        self.file_names = [data for data, _ in files]
+        self._meta_file_names = [meta for _, meta in files]
         self._feature_classes = unique([x[7] for x in query_result])
         self._filesuffixes = unique([x.split("/")[-1] for x in f])
         self._feature_list_table = unique([
@@ -69,6 +73,10 @@ class TableFileSet:
     def filenames(self):
         return self.file_names
 
+    @property
+    def meta_filenames(self):
+        return self._meta_file_names
+
     @property
     def feature_classes(self):
         return self._feature_classes
@@ -22,6 +22,48 @@
 Module for various functions.
 """
 
+import numpy
+
 
 def unique(fl):
     return sorted(list(set(fl)))
+
+
+def ragged_to_dense(values, lengths, fill_value):
+    """
+    Convert a ragged array, i.e. rows of different lengths that are stored
+    consecutively in one flat array, to a dense matrix with a single scatter.
+
+    :param values: the concatenated rows
+    :type values: numpy.ndarray
+    :param lengths: the length of every row
+    :type lengths: numpy.ndarray
+    :param fill_value: the value of the entries beyond the length of a row
+    :return: returns a matrix of rows x maximum row length
+    :rtype: numpy.ndarray
+    """
+
+    lengths = numpy.asarray(lengths)
+    n_col = int(lengths.max()) if len(lengths) else 0
+    mat = numpy.full((len(lengths), n_col), fill_value, dtype=values.dtype)
+    # the position of every value in the flattened matrix is its position
+    # in the flat array shifted by the padding of the previous rows
+    starts = numpy.cumsum(lengths) - lengths
+    shift = numpy.arange(len(lengths)) * n_col - starts
+    mat.reshape(-1)[numpy.arange(len(values)) +
+                    numpy.repeat(shift, lengths)] = values
+    return mat
+
+
+def offsets(lengths):
+    """
+    Compute the offsets of the rows of a ragged array from their lengths.
+
+    :param lengths: the length of every row
+    :type lengths: numpy.ndarray
+    :return: returns an array of the start of every row and the end of the
+     last row
+    :rtype: numpy.ndarray
+    """
+
+    return numpy.concatenate([[0], numpy.cumsum(lengths)]).astype("int64")
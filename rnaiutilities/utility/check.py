@@ -21,26 +21,36 @@
 
 import logging
 
+import numpy
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
 def check_feature_group(fg):
+    """
+    Check if the features of a feature group have the same number of cells
+    for every image. Only the cell counts are compared, so dense and ragged
+    feature matrices are checked without padding them.
+
+    :param fg: the features of a feature group
+    :type fg: list(FeatureMatrix)
+    """
+
     if not isinstance(fg, list):
-        raise "Please provide a list"
-    f1_cells = fg[0].ncells
+        raise TypeError("Please provide a list")
+    f1_cells = numpy.asarray(fg[0].ncells)
     for f in fg:
-        fj_cells = f.ncells
-        for i, fj_cells_i in enumerate(fj_cells):
-            try:
-                if f1_cells[i] != fj_cells_i:
-                    logger.warning(
-                      "Cell numbers between feature {} and feature {} differ: {} vs. {}".
-                          format(fg[0].featurename,
+        fj_cells = numpy.asarray(f.ncells)
+        n = min(len(f1_cells), len(fj_cells))
+        for i in numpy.flatnonzero(f1_cells[:n] != fj_cells[:n]):
+            logger.warning(
+              "Cell numbers between feature {} and feature {} differ: "
+              "{} vs. {}".format(fg[0].featurename,
                                  f.featurename,
                                  f1_cells[i],
-                                 fj_cells_i))
-            except IndexError:
-                logger.warning("Cell array sizes differ: {} vs. {}".format(
-                  fg[0].featurename, f.featurename))
+                                 fj_cells[i]))
+        if len(fj_cells) > len(f1_cells):
+            logger.warning("Cell array sizes differ: {} vs. {}".format(
+              fg[0].featurename, f.featurename))
@@ -22,12 +22,22 @@
 Module for various file related functions.
 """
 
+import json
 import os
 import logging
+import h5py
 import numpy
 import yaml
 from pathlib import Path
 import scipy.io as spio
+from scipy.io.matlab import mat_struct
+
+from rnaiutilities.globals import TSV, DATA_FORMATS
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -35,17 +45,33 @@ logger.setLevel(logging.INFO)
 
 def read_yaml(filename):
     """
-    Read a yaml file into a variable
+    Read a yaml file into a variable. Uses the libyaml loader if available.
 
     :param filename: the yaml file
     :return: returns the yaml as dictionary
     """
 
     with open(filename, "r") as fh:
-        meta = yaml.load(fh)
+        meta = yaml.load(fh, Loader=YamlLoader)
     return meta
 
 
+def read_meta(filename):
+    """
+    Read a meta file of a parsed plate. Meta files are written as JSON, but
+    files from older versions that are written as yaml can be read as well.
+
+    :param filename: the meta file
+    :return: returns the meta information as dictionary
+    """
+
+    with open(filename, "r") as fh:
+        content = fh.read()
+    if content.lstrip().startswith("{"):
+        return json.loads(content)
+    return yaml.load(content, Loader=YamlLoader)
+
+
 def filter_files(path, suffix):
     """
     Find all files in path and filter them by a suffix. Does NOT recurse in the
@@ -82,14 +108,14 @@ def get_base_filesnames(folder, suffix):
     return fls
 
 
-def usable_feature_files(platefileset, usable_features):
+def usable_feature_files(platefileset, usable_features, fmt=TSV):
     available_feature_files = _available_files(platefileset)
     fls = [
-        data_filename(platefileset.outfile + "_" + x) for x in
+        data_filename(platefileset.outfile + "_" + x, fmt) for x in
         usable_features]
     uff = []
     for fl in fls:
-        if any(fl.endswith("_" + av + "_data.tsv") for av in
+        if any(fl.endswith("_" + av + data_filename("", fmt)) for av in
                available_feature_files):
             uff.append(fl)
     return uff
@@ -101,8 +127,25 @@ def _available_files(platefileset):
                [x.featurename.lower() for x in platefileset.files])))
 
 
-def data_filename(filename):
-    return filename + "_data.tsv"
+def data_filename(filename, fmt=TSV):
+    return filename + "_data." + fmt
+
+
+def find_data_filename(filename):
+    """
+    Find the data file that has been written for a plate file prefix in any
+    of the available data formats.
+
+    :param filename: the prefix of the file, i.e. without '_data.tsv'
+    :return: returns the name of the existing data file or the name of the
+     tsv file if no data file exists
+    """
+
+    for fmt in DATA_FORMATS:
+        fl = data_filename(filename, fmt)
+        if Path(fl).exists():
+            return fl
+    return data_filename(filename)
 
 
 def meta_filename(filename):
@@ -119,3 +162,72 @@ def load_matlab(file):
 
     matlab_matrix = spio.loadmat(file)
     return matlab_matrix["handles"][0][0][0][0][0][0][0][0][0][0]
+
+
+def load_measurement(file, dtype="float64"):
+    """
+    Load the single measurement of a matlab feature file as the cells of
+    all images concatenated to one contiguous array. Only the 'handles'
+    variable is decoded and structs are not converted to record arrays.
+    Matlab v7.3 files are read directly as HDF5 files.
+
+    :param file: matlab file name
+    :param dtype: the float type of the values, e.g. 'float64' or 'float32'
+    :return: returns a tuple of the values of the cells of all images and the
+     number of cells of every image
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+
+    try:
+        images = _load_v5_measurement(file)
+    except NotImplementedError:
+        images = _load_h5_measurement(file)
+    rows = [_image_row(x, dtype) for x in images]
+    lengths = numpy.array([len(x) for x in rows], dtype="int64")
+    values = numpy.concatenate(rows) if rows \
+        else numpy.empty(0, dtype=dtype)
+    return values, lengths
+
+
+def _load_v5_measurement(file):
+    mat = spio.loadmat(
+      file, variable_names=["handles"], struct_as_record=False)
+    node = mat["handles"]
+    # descend handles.Measurements.<object>.<feature>, every struct holds a
+    # single field, until the cell array of images is reached
+    while True:
+        if isinstance(node, numpy.ndarray) and node.dtype == object and \
+                node.size == 1 and isinstance(node.flat[0], mat_struct):
+            node = node.flat[0]
+        if not isinstance(node, mat_struct):
+            break
+        node = getattr(node, node._fieldnames[0])
+    return node.ravel()
+
+
+def _load_h5_measurement(file):
+    images = []
+    with h5py.File(file, "r") as fh:
+        node = fh["handles"]
+        while isinstance(node, h5py.Group):
+            node = node[[k for k in node.keys() if not k.startswith("#")][0]]
+        for ref in node[()].ravel():
+            img = fh[ref]
+            # empty matlab arrays are stored as their shape
+            if img.attrs.get("MATLAB_empty", 0):
+                images.append(numpy.empty((0, 1)))
+            else:
+                images.append(img[()].T)
+    return images
+
+
+def _image_row(arr, dtype):
+    # the cells of an image as float array, images that cannot be read
+    # are set to Infinity
+    try:
+        row = numpy.asarray(arr).ravel().astype(dtype, copy=False)
+        if len(row) == len(arr):
+            return row
+    except (ValueError, TypeError):
+        pass
+    return numpy.full(len(arr), numpy.Infinity, dtype=dtype)
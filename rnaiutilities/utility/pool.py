@@ -0,0 +1,64 @@
+# Copyright (C) 2016 Simon Dirmeier
+#
+# This file is part of rnaiutilities.
+#
+# rnaiutilities is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rnaiutilities is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rnaiutilities. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author = 'Simon Dirmeier'
+# @email = 'simon.dirmeier@bsse.ethz.ch'
+
+"""
+Module for mapping functions over iterables with a pool of processes.
+"""
+
+import collections
+import multiprocessing as mp
+
+
+def bounded_imap(func, iterable, workers, initializer=None, initargs=()):
+    """
+    Map a function over an iterable with a pool of processes and yield the
+    results in the order of the iterable. At most two tasks per process are
+    in flight, such that the consumer is never far behind and the results
+    that wait for it are bounded.
+
+    :param func: a picklable function that is called on every element
+    :type func: callable
+    :param iterable: the elements, which are only consumed as far as tasks
+     are submitted
+    :type iterable: iterable
+    :param workers: the number of processes of the pool
+    :type workers: int
+    :param initializer: a picklable function that is called once by every
+     process on *initargs* or None
+    :type initializer: callable
+    :param initargs: the arguments of the initializer
+    :type initargs: tuple
+    :return: returns a generator of the results
+    :rtype: generator
+    """
+
+    pool = mp.Pool(processes=workers,
+                   initializer=initializer, initargs=initargs)
+    try:
+        in_flight = collections.deque()
+        for element in iterable:
+            in_flight.append(pool.apply_async(func, (element,)))
+            if len(in_flight) >= 2 * workers:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -31,6 +31,7 @@ setup(
       'numpy>=1.14.0',
       'scipy>=1.0.0',
       'pandas>=0.23.3',
+      'pyarrow>=0.9.0',
       'psycopg2>=2.7.1',
       'pyyaml>=3.12',
       'tables>=3.3.0',
@@ -50,3 +50,17 @@ class TestConfig(unittest.TestCase):
 
     def test_plate_regex(self):
         assert self._c.plate_regex == ".*\/\w+\-\w[P|U]\-[G|K]\d+(-\w+)*\/.*"
+
+    def test_output_format_defaults_to_tsv(self):
+        assert self._c.output_format == "tsv"
+
+    def test_features_default_to_ragged_float64(self):
+        assert self._c.ragged_features
+        assert self._c.feature_dtype == "float64"
+
+    def test_file_threads_default_to_one(self):
+        assert self._c.file_threads == 1
+
+    def test_workers_default_to_at_least_one(self):
+        assert self._c.workers >= 1
+        assert self._c.tasks_per_child is None
@@ -0,0 +1,104 @@
+# Copyright (C) 2016 Simon Dirmeier
+#
+# This file is part of rnaiutilities.
+#
+# rnaiutilities is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rnaiutilities is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rnaiutilities. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author = 'Simon Dirmeier'
+# @email = 'simon.dirmeier@bssae.ethz.ch'
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy
+import scipy.io as spio
+
+from rnaiutilities.utility.files import load_measurement
+
+
+class TestFiles(unittest.TestCase):
+    """
+    Tests loading the measurement of matlab feature files, which are written
+    either as matlab v5 files or as matlab v7.3, i.e. HDF5, files.
+    """
+
+    # the cells of every image, the third image has no cells
+    images = [[0.5, 1.25, 2.0], [3.5], [], [4.0, numpy.nan]]
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self._folder = tempfile.mkdtemp()
+        self._v5 = os.path.join(self._folder, "Cells.Feature_v5.mat")
+        self._v73 = os.path.join(self._folder, "Cells.Feature_v73.mat")
+        self._write_v5(self._v5)
+        self._write_v73(self._v73)
+
+    def tearDown(self):
+        shutil.rmtree(self._folder)
+
+    @staticmethod
+    def _write_v5(filename):
+        cells = numpy.empty((1, len(TestFiles.images)), dtype=object)
+        for i, img in enumerate(TestFiles.images):
+            cells[0, i] = numpy.array(img, dtype="float64").reshape(-1, 1)
+        spio.savemat(filename, {
+            "handles": {"Measurements": {"Cells": {"Feature": cells}}}})
+
+    @staticmethod
+    def _write_v73(filename):
+        # matlab writes a 512 byte header in front of the HDF5 file, cell
+        # arrays are datasets of references and empty arrays store their shape
+        with h5py.File(filename, "w", userblock_size=512) as fh:
+            refs = fh.create_group("#refs#")
+            cells = []
+            for i, img in enumerate(TestFiles.images):
+                if img:
+                    data = refs.create_dataset(
+                      str(i), data=numpy.array([img], dtype="float64"))
+                else:
+                    data = refs.create_dataset(
+                      str(i), data=numpy.array([0, 0], dtype="uint64"))
+                    data.attrs["MATLAB_empty"] = numpy.uint8(1)
+                cells.append(data.ref)
+            fh.create_group("handles/Measurements/Cells").create_dataset(
+              "Feature", data=numpy.array(cells).reshape(-1, 1),
+              dtype=h5py.ref_dtype)
+        header = b"MATLAB 7.3 MAT-file, Platform: GLNXA64".ljust(116) + \
+            b"\x00" * 8 + b"\x00\x02" + b"IM"
+        with open(filename, "r+b") as fh:
+            fh.write(header.ljust(512, b"\x00"))
+
+    def _assert_measurement(self, values, lengths, dtype):
+        expected = numpy.concatenate(
+          [numpy.array(img, dtype=dtype) for img in TestFiles.images])
+        assert values.dtype == dtype
+        assert lengths.tolist() == [len(img) for img in TestFiles.images]
+        assert numpy.array_equal(values, expected, equal_nan=True)
+
+    def test_load_v5_measurement(self):
+        self._assert_measurement(*load_measurement(self._v5), "float64")
+
+    def test_load_v73_measurement(self):
+        with self.assertRaises(NotImplementedError):
+            spio.loadmat(self._v73)
+        self._assert_measurement(*load_measurement(self._v73), "float64")
+
+    def test_load_float32_measurement(self):
+        for filename in [self._v5, self._v73]:
+            self._assert_measurement(
+              *load_measurement(filename, "float32"), "float32")
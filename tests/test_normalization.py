@@ -0,0 +1,172 @@
+# Copyright (C) 2016 Simon Dirmeier
+#
+# This file is part of rnaiutilities.
+#
+# rnaiutilities is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rnaiutilities is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rnaiutilities. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author = 'Simon Dirmeier'
+# @email = 'simon.dirmeier@bssae.ethz.ch'
+
+
+import unittest
+
+import numpy
+import pandas
+import pytest
+
+from rnaiutilities.normalization.normalizer import Normalizer
+from rnaiutilities.normalization.spatial import well_positions, \
+    median_polish, loess_surface
+from rnaiutilities.normalization.well_statistics import WellStatistics
+
+
+class TestNormalization(unittest.TestCase):
+    """
+    Tests the spatial normalisation of plates on a synthetic 384 well plate
+    with row and column trends.
+    """
+
+    rows = "abcdefghijklmnop"
+    n_cols = 24
+    n_cells = 5
+    columns = ["cells.feature_a", "cells.feature_b", "cells.children_count"]
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        rng = numpy.random.RandomState(23)
+        wells = [r + "{:02d}".format(c + 1)
+                 for r in TestNormalization.rows
+                 for c in range(TestNormalization.n_cols)]
+        self._wells = numpy.repeat(wells, TestNormalization.n_cells)
+        row, col = well_positions(self._wells)
+        # a linear row trend, a linear column trend and cell-wise noise
+        trend = numpy.column_stack([0.5 * row + 0.2 * col, 2.0 - 0.3 * col])
+        noise = rng.normal(0, 0.1, size=trend.shape)
+        counts = rng.randint(0, 10, size=len(self._wells))
+        self._values = numpy.asfortranarray(
+          numpy.column_stack([trend + noise, counts]), dtype="float64")
+
+    def _normalize(self, method, values=None, wells=None):
+        normalizer = Normalizer()
+        normalizer.set_normalization(method, ["count"])
+        values = self._values.copy(order="F") if values is None else values
+        wells = self._wells if wells is None else wells
+        return normalizer.normalize_values(
+          values, TestNormalization.columns, wells)
+
+    @staticmethod
+    def _trend(values, wells):
+        # the largest difference of the medians of plate rows and columns
+        frame = pandas.DataFrame(values[:, :2])
+        row, col = well_positions(pandas.unique(wells))
+        medians = frame.groupby(wells, sort=False).median().values
+        trend = 0
+        for idx in [row, col]:
+            effects = pandas.DataFrame(medians).groupby(idx).median().values
+            trend = max(trend, numpy.nanmax(numpy.ptp(effects, axis=0)))
+        return trend
+
+    def test_synthetic_plate_has_trend(self):
+        assert self._trend(self._values, self._wells) > 4
+
+    def test_bscore_removes_row_and_column_trends(self):
+        values = self._normalize("bscore")
+        assert self._trend(values, self._wells) < 0.5
+
+    def test_loess_removes_row_and_column_trends(self):
+        values = self._normalize("loess")
+        assert self._trend(values, self._wells) < 0.25
+
+    def test_spatial_normalisation_skips_features(self):
+        for method in ["bscore", "loess"]:
+            values = self._normalize(method)
+            assert numpy.array_equal(values[:, 2], self._values[:, 2])
+
+    def test_spatial_normalisation_keeps_nan_wells(self):
+        values = self._values.copy(order="F")
+        nan_wells = numpy.isin(self._wells, ["a01", "c05", "p24"])
+        values[nan_wells, :2] = numpy.nan
+        for method in ["bscore", "loess"]:
+            normalized = self._normalize(method, values.copy(order="F"))
+            assert numpy.isnan(normalized[nan_wells, :2]).all()
+            assert not numpy.isnan(normalized[~nan_wells, :2]).any()
+            assert self._trend(normalized[~nan_wells],
+                               self._wells[~nan_wells]) < 0.5
+
+    def test_spatial_normalisation_with_missing_wells(self):
+        # a missing plate row and some missing wells
+        keep = ~(numpy.char.startswith(self._wells.astype(str), "h") |
+                 numpy.isin(self._wells, ["b02", "k17"]))
+        values, wells = self._values[keep].copy(order="F"), self._wells[keep]
+        for method in ["bscore", "loess"]:
+            normalized = self._normalize(method, values.copy(order="F"), wells)
+            assert not numpy.isnan(normalized).any()
+            assert self._trend(normalized, wells) < 0.5
+
+    def test_spatial_normalisation_skips_unparsable_wells(self):
+        wells = self._wells.astype(object)
+        wells[:TestNormalization.n_cells] = "control"
+        for method in ["bscore", "loess"]:
+            normalized = self._normalize(method, wells=wells)
+            assert numpy.array_equal(normalized, self._values)
+
+    def test_well_statistics_give_the_parameters_of_the_plate(self):
+        values = self._values.copy(order="F")
+        values[:7, 0] = numpy.nan
+        statistics = WellStatistics.from_values(values, self._wells)
+        for method in [["bscore", "zscore"], ["loess", "zscore"],
+                       ["zscore", "bscore"], ["bscore", "loess"]]:
+            normalizer = Normalizer()
+            normalizer.set_normalization(method, ["count"])
+            params = normalizer.fit_wells(
+              statistics, TestNormalization.columns)
+            expected = normalizer.normalize_values(
+              values.copy(order="F"), TestNormalization.columns, self._wells)
+            normalized = normalizer.normalize_values(
+              values.copy(order="F"), TestNormalization.columns, self._wells,
+              params=params)
+            assert numpy.allclose(normalized, expected, equal_nan=True)
+
+    def test_well_statistics_pool_to_plate_moments(self):
+        statistics = WellStatistics.from_values(self._values, self._wells)
+        moments = statistics.moments()
+        assert numpy.allclose(moments.mean, self._values.mean(axis=0))
+        assert numpy.allclose(moments.std, self._values.std(axis=0))
+        assert moments.count.tolist() == [len(self._values)] * 3
+
+    def test_well_positions(self):
+        rows, cols = well_positions(["a01", "P24", "control", "b7"])
+        assert rows.tolist() == [0, 15, -1, 1]
+        assert cols.tolist() == [0, 23, -1, 6]
+
+    def test_median_polish_fits_additive_grid(self):
+        row = numpy.arange(16, dtype="float64")
+        col = numpy.linspace(-1, 1, 24)
+        grid = (3 + row[:, None] + 2 * col[None, :])[:, :, None]
+        grid[2, 3, 0] = numpy.nan
+        overall, row_eff, col_eff = median_polish(grid)
+        fit = overall + row_eff[:, None, :] + col_eff[None, :, :]
+        valid = ~numpy.isnan(grid)
+        assert fit[valid] == pytest.approx(grid[valid])
+
+    def test_loess_surface_fits_linear_surface(self):
+        row, col = numpy.meshgrid(numpy.arange(16), numpy.arange(24),
+                                  indexing="ij")
+        row, col = row.ravel(), col.ravel()
+        values = numpy.column_stack([1 + 2 * row + 3 * col, 0.5 * row])
+        expected = values.astype("float64")
+        values = expected.copy()
+        values[[5, 100, 200], 0] = numpy.nan
+        fit = loess_surface(row, col, values)
+        assert fit == pytest.approx(expected, abs=1e-4)
@@ -22,6 +22,7 @@
 import contextlib
 import glob
 import logging
+import numpy
 import os
 import pandas
 import unittest
@@ -34,6 +35,8 @@ import sys
 import re
 
 from rnaiutilities import Parser, Config
+from rnaiutilities.io.io import IO
+from rnaiutilities.io.plate_cache import PlateCache
 from rnaiutilities.utility.files import read_yaml
 
 
@@ -200,3 +203,138 @@ class TestParser(unittest.TestCase):
         TestParser.parser.featureset_statistics(TestParser.output_stats)
         TestParser.fs_handler.flush()
         assert TestParser.fs_stream.getvalue() == ""
+
+
+class TestParserPool(unittest.TestCase):
+    """
+    Tests that plates parsed by a pool of processes, whose workers read the
+    feature files with several threads, equal the plates parsed by a single
+    process.
+
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        folder = os.path.join(os.path.dirname(__file__), "..", "data")
+        TestParserPool.exp_folder = os.path.join(folder, "out")
+        conf = Config(os.path.join(folder, "config.yml"))
+        conf._plate_id_file = os.path.join(folder, "experiment_meta_file.tsv")
+        conf._plate_regex = ".*\/\w+\-\w[P|U]\-[G|K]\d+(-\w+)*\/.*"
+        conf._layout_file = os.path.join(folder, "layout.tsv")
+        conf._plate_folder = folder
+        conf._output_path = os.path.join(folder, "out", "test_files_pool")
+        conf._multiprocessing = True
+        conf._workers = 2
+        conf._tasks_per_child = 1
+        conf._file_threads = 4
+        TestParserPool.outfolder = conf._output_path
+        if os.path.exists(TestParserPool.outfolder):
+            shutil.rmtree(TestParserPool.outfolder)
+        os.makedirs(TestParserPool.outfolder)
+        Parser(conf).parse()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestParserPool.outfolder)
+
+    def test_data_file_equality(self):
+        for f in TestParser.files:
+            exp_data = pandas.read_csv(
+              os.path.join(TestParserPool.exp_folder, f), sep="\t", header=0)
+            parsed_data = pandas.read_csv(
+              os.path.join(TestParserPool.outfolder, f), sep="\t", header=0)
+            assert exp_data.equals(parsed_data)
+
+    def test_meta_file_equality(self):
+        for f in TestParser.meta:
+            exp_data = read_yaml(os.path.join(TestParserPool.exp_folder, f))
+            parsed_data = read_yaml(os.path.join(TestParserPool.outfolder, f))
+            assert \
+                sorted(exp_data["elements"]) == sorted(parsed_data["elements"])
+            assert exp_data["features"] == parsed_data["features"]
+
+
+class TestParserFeatureLayouts(unittest.TestCase):
+    """
+    Tests that dense feature matrices and float32 features are parsed to
+    the same data files as the default ragged float64 features.
+
+    """
+
+    layouts = {"dense": (False, "float64", "tsv"),
+               "float32": (True, "float32", "tsv"),
+               "float32_parquet": (True, "float32", "parquet")}
+
+    @classmethod
+    def setUpClass(cls):
+        folder = os.path.join(os.path.dirname(__file__), "..", "data")
+        TestParserFeatureLayouts.exp_folder = os.path.join(folder, "out")
+        TestParserFeatureLayouts.outfolders = {}
+        for layout, (ragged, dtype, fmt) in \
+                TestParserFeatureLayouts.layouts.items():
+            conf = Config(os.path.join(folder, "config.yml"))
+            conf._plate_id_file = os.path.join(
+              folder, "experiment_meta_file.tsv")
+            conf._plate_regex = ".*\/\w+\-\w[P|U]\-[G|K]\d+(-\w+)*\/.*"
+            conf._layout_file = os.path.join(folder, "layout.tsv")
+            conf._plate_folder = folder
+            conf._output_path = os.path.join(
+              folder, "out", "test_files_" + layout)
+            conf._ragged_features = ragged
+            conf._feature_dtype = dtype
+            conf._output_format = fmt
+            if os.path.exists(conf._output_path):
+                shutil.rmtree(conf._output_path)
+            os.makedirs(conf._output_path)
+            Parser(conf).parse()
+            TestParserFeatureLayouts.outfolders[layout] = conf._output_path
+
+    @classmethod
+    def tearDownClass(cls):
+        for folder in TestParserFeatureLayouts.outfolders.values():
+            shutil.rmtree(folder)
+
+    def _data(self, layout):
+        fmt = TestParserFeatureLayouts.layouts[layout][2]
+        for f in TestParser.files:
+            exp_data = pandas.read_csv(
+              os.path.join(TestParserFeatureLayouts.exp_folder, f),
+              sep="\t", header=0)
+            parsed_data = IO.read_table(os.path.join(
+              TestParserFeatureLayouts.outfolders[layout],
+              f[:-len("tsv")] + fmt))
+            yield exp_data, parsed_data
+
+    def test_dense_data_file_equality(self):
+        for exp_data, parsed_data in self._data("dense"):
+            assert exp_data.equals(parsed_data)
+
+    def test_float32_data_file_values(self):
+        for exp_data, parsed_data in self._data("float32"):
+            features = [c for c in exp_data.columns if "." in c]
+            assert exp_data.drop(columns=features).equals(
+              parsed_data.drop(columns=features))
+            for c in features:
+                assert numpy.allclose(exp_data[c], parsed_data[c],
+                                      rtol=1e-6, equal_nan=True)
+
+    def test_float32_binary_data_file_values(self):
+        for exp_data, parsed_data in self._data("float32_parquet"):
+            features = [c for c in exp_data.columns if "." in c]
+            for c in features:
+                assert parsed_data[c].dtype == "float32"
+                assert numpy.allclose(exp_data[c], parsed_data[c],
+                                      rtol=1e-6, equal_nan=True)
+
+    def test_cache_stores_float32_features_in_memory_map(self):
+        folder = TestParserFeatureLayouts.outfolders["float32_parquet"]
+        filename = os.path.join(
+          folder, "study-bacteria-d-p-k-1-kb03-1a_cells_data.parquet")
+        table = PlateCache(os.path.join(folder, "cache")).read_table(filename)
+        # features are read-only views of the memory-mapped float64 block
+        col = "cells.intensity_maxintensityedge_corr1actin"
+        assert table[col].dtype == "float64"
+        assert not table[col].values.flags.writeable
+        assert numpy.array_equal(table[col].values,
+                                 IO.read_table(filename)[col].values,
+                                 equal_nan=True)
@@ -26,6 +26,7 @@ import sqlite3
 import unittest
 
 from rnaiutilities import Query
+from rnaiutilities.db.dbms import DBMS
 
 logging.basicConfig(level=logging.DEBUG)
 
@@ -73,9 +74,7 @@ class TestInsert(unittest.TestCase):
         result = c.execute(
             "SELECT name FROM sqlite_master WHERE type='table';").fetchall()
         expected_names = ["gene", "sirna", "well", "meta",
-                          "study_bacteria_d_p_k_1_kb03_1a_cells",
-                          "study_bacteria_d_p_k_1_kb03_1a_nuclei",
-                          "study_bacteria_d_p_k_1_kb03_1a_perinuclei"]
+                          "featureset", "file_featureset", "metafile"]
         for x in result:
             assert x[0] in expected_names
 
@@ -84,6 +83,94 @@ class TestInsert(unittest.TestCase):
         result = c.execute("SELECT * FROM meta;").fetchall()
         assert len(result) == 3
 
+    def test_number_of_featuresets(self):
+        c = self._conn.cursor()
+        result = c.execute("SELECT * FROM file_featureset;").fetchall()
+        assert len(result) == 3
+        result = c.execute(
+          "SELECT distinct featureset FROM featureset;").fetchall()
+        assert len(result) == 3
+
+    def test_reinsertion_skips_inserted_files(self):
+        Query(TestInsert.db_file).insert(TestInsert.path)
+        c = self._conn.cursor()
+        assert len(c.execute("SELECT * FROM meta;").fetchall()) == 3
+        assert len(c.execute("SELECT * FROM gene;").fetchall()) == 3 * 384
+        assert len(c.execute("SELECT * FROM metafile;").fetchall()) == 3
+
+    def test_features_of_older_databases_are_kept(self):
+        # files of databases from older versions are stored in one feature
+        # table per file and have no feature set
+        db = os.path.join(TestInsert.db_folder, "old_features.db")
+        empty = os.path.join(TestInsert.db_folder, "empty")
+        shutil.copy(os.path.join(TestInsert.path, "database.db"), db)
+        os.makedirs(empty)
+        Query(db).insert(empty)
+        with DBMS(db) as d:
+            tablesets = d.tableset()
+        assert len(tablesets) == 1
+        assert len(tablesets[0].features) == 3
+
+    def test_reinsertion_into_older_database_skips_inserted_files(self):
+        # the meta files of the database have been inserted relative to the
+        # test folder by an older version without metafile table
+        db = os.path.join(TestInsert.db_folder, "old_files.db")
+        shutil.copy(os.path.join(TestInsert.path, "database.db"), db)
+        cwd = os.getcwd()
+        try:
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
+            Query(db).insert(os.path.join("..", "data", "out"))
+        finally:
+            os.chdir(cwd)
+        conn = sqlite3.connect(db)
+        c = conn.cursor()
+        assert len(c.execute("SELECT * FROM meta;").fetchall()) == 3
+        assert len(c.execute("SELECT * FROM gene;").fetchall()) == 3 * 384
+        assert len(c.execute("SELECT * FROM metafile;").fetchall()) == 3
+        conn.close()
+
+    def test_reinsertion_replaces_changed_files(self):
+        # the rows of changed files are deleted before they are inserted
+        # again, also if their names contain quotes
+        db = os.path.join(TestInsert.db_folder, "changed.db")
+        path = os.path.join(TestInsert.db_folder, "it's")
+        os.makedirs(path)
+        for f in os.listdir(TestInsert.path):
+            if f.endswith("_meta.tsv"):
+                shutil.copy(os.path.join(TestInsert.path, f), path)
+        Query(db).insert(path)
+        for f in os.listdir(path):
+            st = os.stat(os.path.join(path, f))
+            os.utime(os.path.join(path, f), (st.st_atime, st.st_mtime + 1))
+        Query(db).insert(path)
+        conn = sqlite3.connect(db)
+        c = conn.cursor()
+        assert len(c.execute("SELECT * FROM meta;").fetchall()) == 3
+        assert len(c.execute("SELECT * FROM gene;").fetchall()) == 3 * 384
+        assert len(c.execute("SELECT * FROM metafile;").fetchall()) == 3
+        assert len(c.execute(
+          "SELECT * FROM file_featureset;").fetchall()) == 3
+        conn.close()
+
+    def test_parallel_batched_insertion_equals_serial_insertion(self):
+        db = os.path.join(TestInsert.db_folder, "parallel.db")
+        batch_size = DBMS._BATCH_SIZE_
+        try:
+            # one transaction per meta file
+            DBMS._BATCH_SIZE_ = 1
+            Query(db).insert(TestInsert.path, workers=2)
+        finally:
+            DBMS._BATCH_SIZE_ = batch_size
+        conn = sqlite3.connect(db)
+        for tab in ["meta", "gene", "sirna", "well", "featureset",
+                    "file_featureset", "metafile"]:
+            q = "SELECT * FROM {};".format(tab)
+            parallel = conn.cursor().execute(q).fetchall()
+            serial = self._conn.cursor().execute(q).fetchall()
+            assert len(parallel) > 0
+            assert sorted(parallel, key=str) == sorted(serial, key=str)
+        conn.close()
+
     def test_number_of_gene_elements(self):
         c = self._conn.cursor()
         result = c.execute("SELECT * FROM gene;").fetchall()
@@ -0,0 +1,223 @@
+# Copyright (C) 2016 Simon Dirmeier
+#
+# This file is part of rnaiutilities.
+#
+# rnaiutilities is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# rnaiutilities is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with rnaiutilities. If not, see <http://www.gnu.org/licenses/>.
+#
+# @author = 'Simon Dirmeier'
+# @email = 'simon.dirmeier@bssae.ethz.ch'
+
+
+import glob
+import os
+import shutil
+import unittest
+from unittest import mock
+
+import numpy
+import pandas
+
+from rnaiutilities import Parser, Config, Query
+from rnaiutilities.globals import ROW_INDEX, MOMENTS, WELL_STATISTICS
+from rnaiutilities.io.io import IO
+from rnaiutilities.plate_writer import PlateWriter
+from rnaiutilities.query_result import QueryResult
+from rnaiutilities.utility.files import read_meta
+
+
+class TestQueryParsed(unittest.TestCase):
+    """
+    Tests querying plates that have been parsed by the current version, i.e.
+    whose meta files have a row index and feature moments, in every data
+    file format.
+    """
+
+    folder = os.path.join(os.path.dirname(__file__), "..", "data")
+    out_folder = os.path.join(folder, "out", "test_indexed")
+    formats = ["tsv", "parquet", "feather"]
+    db_file = os.path.join(out_folder, "tsv", "database.db")
+    data_file = "study-bacteria-d-p-k-1-kb03-1a_cells_data."
+
+    @classmethod
+    def setUpClass(cls):
+        if os.path.exists(TestQueryParsed.out_folder):
+            shutil.rmtree(TestQueryParsed.out_folder)
+        for fmt in TestQueryParsed.formats:
+            folder = os.path.join(TestQueryParsed.out_folder, fmt)
+            os.makedirs(folder)
+            TestQueryParsed._parse(folder, fmt)
+            Query(TestQueryParsed._db_file(fmt)).insert(folder)
+        TestQueryParsed.full_data = TestQueryParsed._compose(
+          "data_full.tsv")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(TestQueryParsed.out_folder)
+
+    @staticmethod
+    def _parse(out_folder, fmt):
+        folder = TestQueryParsed.folder
+        conf = Config(os.path.join(folder, "config.yml"))
+        conf._plate_id_file = os.path.join(folder, "experiment_meta_file.tsv")
+        conf._plate_regex = ".*\/\w+\-\w[P|U]\-[G|K]\d+(-\w+)*\/.*"
+        conf._layout_file = os.path.join(folder, "layout.tsv")
+        conf._plate_folder = folder
+        conf._output_path = out_folder
+        conf._output_format = fmt
+        Parser(conf).parse()
+
+    @staticmethod
+    def _db_file(fmt):
+        return os.path.join(TestQueryParsed.out_folder, fmt, "database.db")
+
+    @staticmethod
+    def _compose(name, db_file=None, chunk_size=None, sample=None,
+                 normalize="zscore", **kwargs):
+        out = os.path.join(TestQueryParsed.out_folder, name)
+        Query(db_file or TestQueryParsed.db_file).compose(**kwargs).dump(
+          sample=sample, normalize=normalize, fh=out, chunk_size=chunk_size)
+        return pandas.read_csv(out, sep="\t", header=0)
+
+    @staticmethod
+    def _assert_features_equal(composed, expected):
+        assert len(composed) == len(expected)
+        features = [c for c in expected.columns if "." in c]
+        assert expected.drop(columns=features).equals(
+          composed.drop(columns=features))
+        for c in features:
+            assert numpy.allclose(expected[c], composed[c], equal_nan=True)
+
+    def test_binary_formats_read_like_tsv(self):
+        tsv = IO.read_table(os.path.join(
+          TestQueryParsed.out_folder, "tsv",
+          TestQueryParsed.data_file + "tsv"))
+        # the plate has several row groups/record batches
+        assert len(tsv) > 3 * PlateWriter._row_group_size_
+        rows = numpy.array([0, 1, 2 ** 16 - 1, 2 ** 16, 2 ** 16 + 1,
+                            3 * 2 ** 16 + 7, len(tsv) - 1])
+        for fmt in TestQueryParsed.formats[1:]:
+            filename = os.path.join(TestQueryParsed.out_folder, fmt,
+                                    TestQueryParsed.data_file + fmt)
+            data = IO.read_table(filename)
+            self._assert_features_equal(data.astype(tsv.dtypes), tsv)
+            selected = IO.read_table(filename, rows=rows)
+            self._assert_features_equal(
+              selected.astype(tsv.dtypes),
+              tsv.iloc[rows].reset_index(drop=True))
+            # chunks that do not align with the row groups
+            chunks = list(IO.iter_table(filename, size=50000))
+            assert all(len(c) == 50000 for c in chunks[:-1])
+            self._assert_features_equal(
+              pandas.concat(chunks, ignore_index=True).astype(tsv.dtypes),
+              tsv)
+
+    def test_iter_table_chunks_within_blocks(self):
+        filename = os.path.join(TestQueryParsed.out_folder, "tsv",
+                                TestQueryParsed.data_file + "tsv")
+        tsv = IO.read_table(filename)
+        # several chunks per block read and chunks that span two blocks
+        chunks = list(IO.iter_table(filename, size=7000))
+        assert all(len(c) == 7000 for c in chunks[:-1])
+        assert all(c.index[0] == 0 for c in chunks)
+        self._assert_features_equal(
+          pandas.concat(chunks, ignore_index=True), tsv)
+
+    def test_binary_formats_compose_like_tsv(self):
+        for fmt in TestQueryParsed.formats[1:]:
+            db_file = TestQueryParsed._db_file(fmt)
+            self._assert_features_equal(
+              self._compose("data_full_{}.tsv".format(fmt), db_file),
+              TestQueryParsed.full_data)
+
+    def test_binary_formats_compose_filtered_chunks_like_tsv(self):
+        queries = [{"chunk_size": 50000}, {"gene": "atp6v1a"},
+                   {"chunk_size": 1000, "gene": "atp6v1a"},
+                   {"sample": 10, "seed": 23}]
+        for i, kwargs in enumerate(queries):
+            expected = self._compose("data_tsv_{}.tsv".format(i), **kwargs)
+            for fmt in TestQueryParsed.formats[1:]:
+                composed = self._compose(
+                  "data_{}_{}.tsv".format(fmt, i),
+                  TestQueryParsed._db_file(fmt), **kwargs)
+                self._assert_features_equal(composed, expected)
+
+    def test_meta_files_have_index_and_moments(self):
+        metas = glob.glob(
+          os.path.join(TestQueryParsed.out_folder, "tsv", "*_meta.tsv"))
+        assert len(metas) == 3
+        for meta_file in metas:
+            meta = read_meta(meta_file)
+            assert meta[ROW_INDEX]
+            assert len(meta[MOMENTS]["mean"]) == len(meta["features"])
+            wells = meta[WELL_STATISTICS]
+            assert len(wells["wells"]) == 384
+            assert numpy.array(wells["median"]).shape == \
+                (384, len(meta["features"]))
+
+    def test_filtered_compose_uses_stored_moments(self):
+        # the rows of other wells are neither read for the statistics
+        with mock.patch.object(QueryResult, "_plate_moments") as streamed:
+            composed = self._compose(
+              "data_gene.tsv", gene="atp6v1a", well="a01")
+            streamed.assert_not_called()
+        full = TestQueryParsed.full_data
+        full = full[(full.gene == "atp6v1a") & (full.well == "a01")] \
+            .reset_index(drop=True)
+        assert len(full) > 0
+        self._assert_features_equal(composed, full)
+
+    def test_filtered_compose_in_chunks_uses_stored_moments(self):
+        with mock.patch.object(QueryResult, "_plate_moments") as streamed:
+            composed = self._compose(
+              "data_gene_chunks.tsv", chunk_size=100, gene="atp6v1a")
+            streamed.assert_not_called()
+        full = TestQueryParsed.full_data
+        full = full[full.gene == "atp6v1a"].reset_index(drop=True)
+        self._assert_features_equal(composed, full)
+
+    def test_filtered_spatial_compose_uses_stored_well_statistics(self):
+        queries = [{"gene": "atp6v1a", "well": "a01"},
+                   {"chunk_size": 1000, "gene": "atp6v1a"},
+                   {"sample": 10, "seed": 23}]
+        for normalize in [["bscore", "zscore"], ["loess"]]:
+            name = "_".join(normalize)
+            full = self._compose(
+              "data_full_{}.tsv".format(name), normalize=normalize)
+            for i, kwargs in enumerate(queries):
+                # no reference rows of other wells are read
+                with mock.patch.object(
+                      QueryResult, "_reference_rows") as reference:
+                    composed = self._compose(
+                      "data_{}_{}.tsv".format(name, i), normalize=normalize,
+                      **kwargs)
+                    reference.assert_not_called()
+                if "sample" in kwargs:
+                    expected = full.merge(
+                      composed[["well", "image_idx", "object_idx"]])
+                else:
+                    match = full.gene == kwargs["gene"]
+                    if "well" in kwargs:
+                        match &= full.well == kwargs["well"]
+                    expected = full[match].reset_index(drop=True)
+                assert len(expected) > 0
+                self._assert_features_equal(composed, expected)
+
+    def test_stored_moments_equal_streamed_moments(self):
+        res = Query(TestQueryParsed.db_file).compose()
+        tablefileset = res._tablefile_sets[0]
+        stored = res._stored_moments(tablefileset)
+        streamed = res._plate_moments(tablefileset)
+        assert numpy.array_equal(stored.count, streamed.count)
+        assert numpy.allclose(stored.mean, streamed.mean, equal_nan=True)
+        assert numpy.allclose(stored.std, streamed.std, equal_nan=True)
@@ -20,6 +20,7 @@
 
 
 import logging
+import multiprocessing as mp
 import numpy
 import os
 import unittest
@@ -28,10 +29,26 @@ import pytest
 import shutil
 
 from rnaiutilities import Query
+from rnaiutilities.io.io import IO
+from rnaiutilities.io.plate_cache import PlateCache
 
 logging.basicConfig(level=logging.DEBUG)
 
 
+def _read_cached(args):
+    # reads the files from a cache that only fits a single entry, such that
+    # the processes evict the entries the others read
+    folder, files = args
+    cache = PlateCache(folder, max_size=1)
+    for _ in range(2):
+        for f in files:
+            table = cache.read_table(f, lambda x: x == "well" or "." in x)
+            if not table.equals(
+              IO.read_table(f, lambda x: x == "well" or "." in x)):
+                return False
+    return True
+
+
 class TestQuery(unittest.TestCase):
     """
     Tests the control querying module for data base querying.
@@ -71,8 +88,7 @@ class TestQuery(unittest.TestCase):
 
         Query(TestQuery.out_db_file).insert(TestQuery.db_folder)
 
-        TestQuery.res = Query(TestQuery.out_db_file).compose()
-        numpy.random.seed(23)
+        TestQuery.res = Query(TestQuery.out_db_file).compose(seed=23)
         TestQuery.res.dump(sample=10, normalize="zscore",
                            fh=TestQuery.out_file_sampled)
         TestQuery.res.dump(sample=None, normalize="zscore",
@@ -86,7 +102,6 @@ class TestQuery(unittest.TestCase):
           TestQuery.out_file_full, sep='\t', header=0)
 
         ou = os.path.join(TestQuery.out_folder, "data_sampled_unnorm.tsv")
-        numpy.random.seed(23)
         TestQuery.res.dump(sample=10, normalize=None, fh=ou)
         exf = os.path.join(TestQuery.db_folder, "data_unnormalized.tsv")
         TestQuery.ex_non_norm = pandas.read_csv(exf, sep='\t', header=0)
@@ -133,12 +148,12 @@ class TestQuery(unittest.TestCase):
             "nuclei.intensity_uppertenpercentintensity_corr1pathogen"]
         per_col = TestQuery.composed_non_norm[
             "perinuclei.intensity_upperquartileintensity_corr1actin"]
-        assert cell_col.values[0] == pytest.approx(0.1628, 0.01)
-        assert cell_col.values[6] == pytest.approx(0.206, 0.01)
-        assert nuc_col.values[0] == pytest.approx(0.0145, 0.01)
-        assert nuc_col.values[6] == pytest.approx(0.01498, 0.01)
-        assert per_col.values[0] == pytest.approx(0.100, 0.01)
-        assert per_col.values[6] == pytest.approx(0.066, 0.01)
+        assert cell_col.values[0] == pytest.approx(0.1014, 0.01)
+        assert cell_col.values[6] == pytest.approx(0.1544, 0.01)
+        assert nuc_col.values[0] == pytest.approx(0.0150, 0.01)
+        assert nuc_col.values[6] == pytest.approx(0.01143, 0.01)
+        assert per_col.values[0] == pytest.approx(0.064, 0.01)
+        assert per_col.values[6] == pytest.approx(0.088, 0.01)
 
     def test_compose_creates_correct_columns(self):
         for c in TestQuery.composed_sampled_data.columns:
@@ -149,6 +164,135 @@ class TestQuery(unittest.TestCase):
           ["gene", "sirna", "well"]).size().reset_index(name='counts')
         assert all(cnts["counts"] == 10)
 
+    def test_compose_with_workers_creates_same_data(self):
+        out = os.path.join(TestQuery.out_folder, "data_full_workers.tsv")
+        TestQuery.res.dump(sample=None, normalize="zscore", fh=out, workers=2)
+        composed = pandas.read_csv(out, sep='\t', header=0)
+        assert TestQuery.composed_full_data.equals(composed)
+
+    def test_compose_on_screen_level_equals_single_plate(self):
+        out = os.path.join(TestQuery.out_folder, "data_full_screen.tsv")
+        TestQuery.res.dump(sample=None, normalize="zscore", fh=out,
+                           level="screen")
+        composed = pandas.read_csv(out, sep='\t', header=0)
+        for c in TestQuery.expected_feature_columns:
+            assert numpy.allclose(TestQuery.composed_full_data[c],
+                                  composed[c], equal_nan=True)
+
+    def test_compose_with_regex_filter_equals_exact_filter(self):
+        exact = os.path.join(TestQuery.out_folder, "data_gene_exact.tsv")
+        regex = os.path.join(TestQuery.out_folder, "data_gene_regex.tsv")
+        self._query.compose(gene="atp6v1a", seed=1).dump(
+          sample=None, normalize="zscore", fh=exact)
+        self._query.compose(gene="atp.*", regex=True, seed=1).dump(
+          sample=None, normalize="zscore", fh=regex)
+        exact = pandas.read_csv(exact, sep='\t', header=0)
+        assert exact.gene.unique().tolist() == ["atp6v1a"]
+        assert exact.equals(pandas.read_csv(regex, sep='\t', header=0))
+
+    def test_compose_sampled_rows_equal_full_rows(self):
+        keys = ["well", "image_idx", "object_idx"]
+        merged = TestQuery.composed_sampled_data.merge(
+          TestQuery.composed_full_data, on=keys, suffixes=("", "_full"))
+        assert len(merged) == len(TestQuery.composed_sampled_data)
+        for c in TestQuery.expected_feature_columns:
+            assert numpy.allclose(merged[c], merged[c + "_full"],
+                                  equal_nan=True)
+
+    def test_compose_with_filter_equals_filtered_full_data(self):
+        out = os.path.join(TestQuery.out_folder, "data_gene_full.tsv")
+        self._query.compose(gene="atp6v1a").dump(
+          sample=None, normalize="zscore", fh=out)
+        composed = pandas.read_csv(out, sep='\t', header=0)
+        full = TestQuery.composed_full_data
+        full = full[full.gene == "atp6v1a"].reset_index(drop=True)
+        assert len(composed) == len(full)
+        for c in TestQuery.expected_feature_columns:
+            assert numpy.allclose(full[c], composed[c], equal_nan=True)
+
+    def test_unseeded_compose_is_deterministic(self):
+        composed = []
+        for i in range(2):
+            out = os.path.join(TestQuery.out_folder,
+                               "data_gene_unseeded_{}.tsv".format(i))
+            self._query.compose(gene="atp6v1a").dump(
+              sample=None, normalize=["bscore", "zscore"], fh=out)
+            composed.append(pandas.read_csv(out, sep='\t', header=0))
+        assert composed[0].equals(composed[1])
+
+    def test_compose_from_cache_creates_same_data(self):
+        cache = os.path.join(TestQuery.out_folder, "cache")
+        for i in range(2):
+            out = os.path.join(TestQuery.out_folder,
+                               "data_sampled_cache_{}.tsv".format(i))
+            Query(TestQuery.out_db_file).compose(seed=23, cache=cache).dump(
+              sample=10, normalize="zscore", fh=out)
+            composed = pandas.read_csv(out, sep='\t', header=0)
+            assert TestQuery.composed_sampled_data.equals(composed)
+        assert len(self._entries(cache)) == 3
+
+    def test_cache_reads_features_from_memory_map(self):
+        cache = PlateCache(os.path.join(TestQuery.out_folder, "cache_mmap"))
+        filename = os.path.join(
+          TestQuery.db_folder, "study-bacteria-d-p-k-1-kb03-1a_cells_data.tsv")
+        for _ in range(2):
+            table = cache.read_table(filename)
+        # feature columns are read-only views of the memory-mapped block
+        col = "cells.intensity_maxintensityedge_corr1actin"
+        assert not table[col].values.flags.writeable
+        assert table.equals(IO.read_table(filename))
+
+    def test_cache_evicts_least_recently_used_entries(self):
+        folder = os.path.join(TestQuery.out_folder, "cache_evict")
+        files = [os.path.join(TestQuery.db_folder, f) for f in [
+            "study-bacteria-d-p-k-1-kb03-1a_cells_data.tsv",
+            "study-bacteria-d-p-k-1-kb03-1a_nuclei_data.tsv"]]
+        cache = PlateCache(folder)
+        for f in files:
+            cache.read_table(f, lambda x: x == "well")
+        assert len(self._entries(folder)) == 2
+        # a cache that only fits one entry keeps the most recently read one
+        cache = PlateCache(folder, max_size=1)
+        cache.read_table(files[0], lambda x: x == "well")
+        assert len(self._entries(folder)) == 1
+        assert cache.read_table(files[0], lambda x: x == "well") \
+            .equals(IO.read_table(files[0], lambda x: x == "well"))
+
+    def test_cache_shared_by_processes_evicts_safely(self):
+        folder = os.path.join(TestQuery.out_folder, "cache_shared")
+        files = [os.path.join(TestQuery.db_folder, f) for f in [
+            "study-bacteria-d-p-k-1-kb03-1a_cells_data.tsv",
+            "study-bacteria-d-p-k-1-kb03-1a_nuclei_data.tsv",
+            "study-bacteria-d-p-k-1-kb03-1a_perinuclei_data.tsv"]]
+        # every process reads the files in a different order
+        args = [(folder, files[i:] + files[:i]) for i in range(3)] * 2
+        with mp.Pool(4) as pool:
+            assert all(pool.map(_read_cached, args))
+        assert len(self._entries(folder)) == 1
+
+    @staticmethod
+    def _entries(folder):
+        # the lock file of the cache is hidden
+        return [f for f in os.listdir(folder) if not f.startswith(".")]
+
+    def test_compose_in_chunks_creates_same_data(self):
+        out = os.path.join(TestQuery.out_folder, "data_sampled_chunks.tsv")
+        Query(TestQuery.out_db_file).compose(seed=23).dump(
+          sample=10, normalize="zscore", fh=out, chunk_size=100)
+        composed = pandas.read_csv(out, sep='\t', header=0)
+        assert TestQuery.composed_sampled_data.equals(composed)
+
+    def test_compose_to_h5_creates_same_data(self):
+        out = os.path.join(TestQuery.out_folder, "data_sampled.h5")
+        Query(TestQuery.out_db_file).compose(seed=23).dump(
+          sample=10, normalize="zscore", fh=out)
+        composed = pandas.read_hdf(out, "data")
+        for c in TestQuery.expected_feature_columns:
+            assert numpy.allclose(TestQuery.composed_sampled_data[c],
+                                  composed[c], equal_nan=True)
+        genes = pandas.read_hdf(out, "data", where="gene == 'atp6v1a'")
+        assert len(genes) == sum(composed.gene == "atp6v1a")
+
     def test_compose_creates_zero_mean_columns(self):
         for c in TestQuery.expected_feature_columns:
             assert TestQuery.composed_full_data[c].mean() == \